@@ -0,0 +1,94 @@
+"""
+benchmark of the temp store value encodings (see cipherwallet/codec.py): encoding and decoding
+    time, and bytes stored, for the values a signup session writes
+
+    python benchmarks/bench_codec.py --user-data-kb 4 --rounds 2000
+
+for every codec, and with or without the compression of the values of --compress-min bytes
+    or more, it reports the time to encode() and decode() each value, the time to turn the
+    user data into the JSON returned to the browser (as_json()), and the bytes stored per
+    session; the msgpack codec needs the msgpack package
+"""
+import os
+import sys
+import imp
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def sample_values(user_data_kb):
+    """
+    the values of a signup session: the cipherwallet session variables, the data posted by
+        the mobile app (its size set by padding the form with more fields) and the new
+        user's login credentials
+    """
+    rnd = random.Random(1)
+    words = [ "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(3, 10))) for _ in range(500) ]
+    session = { 'qr_expires': int(time.time()) + 120, 'user_id': "user@example.com" }
+    user_data = {
+        'user': { 'first': u"Jane", 'last': u"Doe", 'email': u"jane.doe@example.com", 'phone': u"+1 555 0100" },
+        'address': { 'street': u"1 Main St", 'city': u"Springfield", 'zip': u"12345", 'country': u"US" },
+    }
+    while len(repr(user_data)) < user_data_kb * 1024:
+        user_data['field_{0}'.format(len(user_data))] = u" ".join(rnd.choice(words) for _ in range(rnd.randint(1, 12)))
+    creds = {
+        'registration': "4f3c2a1e-8b7d-4c6a-9e5f-0a1b2c3d4e5f", 'cw_id': "cw7xk2mq9p",
+        'secret': "".join(rnd.choice("0123456789abcdef") for _ in range(64)), 'hash_method': "sha256",
+    }
+    return [ ("session", session), ("user_data", user_data), ("signup_reg", creds) ]
+
+
+def per_call(f, arg, rounds):
+    t0 = time.time()
+    for _ in range(rounds):
+        f(arg)
+    return (time.time() - t0) / rounds
+
+def run(codec, values, rounds):
+    stored = 0
+    line = []
+    for name, value in values:
+        data = codec.encode(value)
+        assert codec.decode(data) == value
+        stored += len(data)
+        line.append("{0} {1:6d}B enc {2:6.1f}us dec {3:6.1f}us".format(
+            name, len(data), per_call(codec.encode, value, rounds) * 1e6, per_call(codec.decode, data, rounds) * 1e6
+        ))
+        if name == "user_data":
+            line[-1] += " json {0:6.1f}us".format(per_call(codec.as_json, data, rounds) * 1e6)
+    return stored, line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark of the temp store value encodings")
+    parser.add_argument("--user-data-kb", type=float, default=4, help="size of the signup form data")
+    parser.add_argument("--compress-min", type=int, default=1024, help="TMPSTORE_COMPRESS_MIN, when compressing")
+    parser.add_argument("--rounds", type=int, default=2000, help="calls per measurement")
+    args = parser.parse_args(argv)
+
+    # codec.py only needs the (default) settings
+    sys.modules["cipherwallet.constants"] = imp.new_module("cipherwallet.constants")
+    from cipherwallet import codec
+
+    values = sample_values(args.user_data_kb)
+    for name in [ "json", "msgpack" ]:
+        for compress_min in [ 0, args.compress_min ]:
+            codec.TMPSTORE_CODEC, codec.TMPSTORE_COMPRESS_MIN = name, compress_min
+            try:
+                stored, lines = run(codec, values, args.rounds)
+            except ImportError as e:
+                print("{0}: {1}".format(name, e))
+                break
+            print("{0}{1}: {2} bytes per session".format(
+                name, " + zlib >= {0}B".format(compress_min) if compress_min else "", stored
+            ))
+            for line in lines:
+                print("    " + line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+micro-benchmark of the CQR request signatures (see cipherwallet/cqr_auth.py), that sign
+    every request to the cipherwallet API and check every callback from it:
+
+    python benchmarks/bench_cqr.py --params 6 --rounds 20000
+
+for every hash method, it reports the time to compute a signature, the way it was done
+    before the keyed HMAC states got reused (a new HMAC from the raw key, the signature
+    string concatenated piece by piece) and the way it's done now, then the time of a whole
+    auth() (the headers of an API request) and of a whole verify() (a callback, including
+    the timestamp and nonce checks, with the memory temp store); the figures are per call,
+    the best of 3 runs (verify() runs once, since the nonces can't be used again)
+"""
+import time
+import hmac
+import base64
+import hashlib
+import argparse
+import tempfile
+import shutil
+
+from bench_settings import install_settings
+
+RESOURCE = "/signup/bench"
+
+
+def previous_signed(secret_key, hash_method, http_method, resource, headers, params):
+    """
+    the signature as auth() computed it before: concatenation, and a new HMAC every time
+    """
+    signature = http_method.upper() + " " + resource.lower() + "\n"
+    for k, v in headers:
+        signature = signature + k + ":" + v + "\n"
+    for k in sorted(params.iterkeys()):
+        signature = signature + k + "=" + str(params[k]) + "\n"
+    if len(params):
+        signature = signature[:-1]
+    h = hmac.new(secret_key, signature, getattr(hashlib, hash_method))
+    return base64.b64encode(h.digest())
+
+def current_signed(cqr_auth, secret_key, hash_method, http_method, resource, headers, params):
+    """
+    the signature as auth() computes it now
+    """
+    signature = "\n".join(
+        [ http_method.upper() + " " + resource.lower() ] +
+        [ k + ":" + v for k, v in headers ]
+    ) + "\n"
+    signature += "\n".join(k + "=" + str(params[k]) for k in sorted(params.iterkeys()))
+    return cqr_auth.signed(secret_key, hash_method, signature)
+
+
+def per_call(f, args_list, repeat=3):
+    # the best of a few runs, like timeit
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        for args in args_list:
+            f(*args)
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(args_list)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="micro-benchmark of the CQR request signatures")
+    parser.add_argument("--params", type=int, default=6, help="request parameters signed")
+    parser.add_argument("--rounds", type=int, default=20000, help="calls per measurement")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="cw-bench-cqr-")
+    try:
+        constants = install_settings("memory", workdir, "http://127.0.0.1:1")
+        from cipherwallet import cqr_auth
+
+        secret = constants.API_SECRET
+        params = dict(("param_{0}".format(i), "value {0}".format(i) * 3) for i in range(args.params))
+        for hash_method in sorted(cqr_auth.HASH_METHODS):
+            headers = cqr_auth.auth(constants.CUSTOMER_ID, secret, "POST", RESOURCE, params, hash_method)
+            signed_headers = [ (k, headers[k]) for k in headers if k != 'Authorization' ]
+            sig_args = (secret, hash_method, "POST", RESOURCE, signed_headers, params)
+            assert "CQR 1.0 " + previous_signed(*sig_args) == headers['Authorization']
+            assert "CQR 1.0 " + current_signed(cqr_auth, *sig_args) == headers['Authorization']
+            before = per_call(previous_signed, [ sig_args ] * args.rounds)
+            after = per_call(lambda *a: current_signed(cqr_auth, *a), [ sig_args ] * args.rounds)
+
+            auth_args = (constants.CUSTOMER_ID, secret, "POST", RESOURCE, params, hash_method)
+            auth = per_call(cqr_auth.auth, [ auth_args ] * args.rounds)
+            # every callback comes with its own nonce
+            callbacks = []
+            for _ in range(args.rounds):
+                headers = cqr_auth.auth(*auth_args)
+                callbacks.append(("POST", RESOURCE, headers, params, headers['Authorization']))
+            assert cqr_auth.verify(*callbacks[0]) and not cqr_auth.verify(*callbacks[0])
+            verify = per_call(cqr_auth.verify, callbacks[1:], repeat=1)
+
+            print("{0:7s} signature {1:6.2f}us before, {2:6.2f}us now ({3:+.0f}%)   auth() {4:6.2f}us   verify() {5:6.2f}us".format(
+                hash_method, before * 1e6, after * 1e6, (after - before) / before * 100, auth * 1e6, verify * 1e6
+            ))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
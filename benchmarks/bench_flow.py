@@ -0,0 +1,339 @@
+"""
+end-to-end benchmark of the cipherwallet web app handlers, offline
+
+every simulated browser goes thru a signup (QR code, polls, mobile app data upload, poll
+    picking up the data, QR login registration) and then thru a QR login (QR code, polls,
+    login callback from the API, poll authorizing the user); the requests are sent directly
+    to the bottle WSGI app in api_router.py, so the figures dont include any web server
+the cipherwallet API is played by a local HTTP server, the database is a scratch sqlite
+    file, and each temp store gets benchmarked in its own process (the store is chosen when
+    the library gets imported):
+
+    python benchmarks/bench_flow.py --stores memory,sessionfiles,mmap,redis --sessions 500
+    python benchmarks/bench_flow.py --save baseline.json
+    python benchmarks/bench_flow.py --baseline baseline.json --tolerance 20
+
+'redis' runs against fakeredis; 'memcached' needs a memcached server (--memcached). the
+    exit status is 1 when a flow failed, or the benchmark of a store did not complete; with
+    --baseline, also when a p50 / p99 latency got worse (or the requests per second got
+    fewer) by more than --tolerance percent
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import urllib
+import argparse
+import tempfile
+import threading
+import subprocess
+import wsgiref.util
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from bench_settings import ROOT, install_settings
+
+STORES = [ "memory", "sessionfiles", "mmap", "redis", "memcached" ]
+SIGNUP_TAG = "signup-form-qr"
+LOGIN_TAG = "login-form-qr"
+with open(os.path.join(ROOT, "cipherwallet", "1x1.png"), "rb") as fh:
+    PNG = fh.read()
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """
+    the cipherwallet API, as much as the SDK gets to see of it: QR code images and
+        registration confirmations, after an optional delay
+    """
+    latency = 0
+    # headers and body in one packet, or the delayed ACKs make up most of the request time
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply("image/png", PNG)
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply("application/json", "{}")
+
+    def reply(self, content_type, body):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    protocol_version = "HTTP/1.1"
+
+
+def start_fake_api(latency):
+    FakeAPIHandler.protocol_version = "HTTP/1.1"
+    FakeAPIHandler.latency = latency
+    server = FakeAPIServer(("127.0.0.1", 0), FakeAPIHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return "http://127.0.0.1:{0}".format(server.server_address[1])
+
+
+class Browser(object):
+    """
+    sends requests to the WSGI app, keeps the cookies, and times every request
+    """
+
+    def __init__(self, app, timings):
+        self.app = app
+        self.timings = timings
+        self.cookies = {}
+
+    def request(self, label, method, path, body="", content_type=None, headers={}):
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'HTTP_COOKIE': "; ".join("{0}={1}".format(k, v) for k, v in self.cookies.items()),
+        })
+        if content_type:
+            environ['CONTENT_TYPE'] = content_type
+        for k, v in headers.items():
+            environ['HTTP_' + k.upper().replace("-", "_")] = v
+        response = {}
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = response_headers
+        t0 = time.time()
+        rp_body = "".join(self.app(environ, start_response))
+        self.timings.setdefault(label, []).append(time.time() - t0)
+        for k, v in response['headers']:
+            if k == "Set-Cookie":
+                name, value = v.split(";")[0].split("=", 1)
+                self.cookies[name] = value.strip('"')
+        return response['status'], rp_body
+
+
+def run_flow(app, cqr, timings, polls):
+    """
+    one browser (and its mobile app) signing up, and then logging in with a QR code
+    """
+    browser = Browser(app, timings)
+    user_id = "user-" + uuid.uuid4().hex
+
+    # signup: the QR code, then polls until the mobile app uploads the user data
+    browser.request("qr", "GET", "/cipherwallet/{0}/qr.png".format(SIGNUP_TAG))
+    session = browser.cookies["cwsession-" + SIGNUP_TAG]
+    for _ in range(polls):
+        browser.request("poll (waiting)", "GET", "/cipherwallet/" + SIGNUP_TAG)
+    status, _ = browser.request("callback_with_data", "POST", "/cipherwallet/signup", json.dumps({
+        'session': session,
+        'user_data': { 'user': { 'first': "Bench", 'last': "Mark" }, 'email': user_id },
+        'reg_meta': { 'tag': str(uuid.uuid4()), 'complete_timer': 60 },
+    }), "application/json")
+    assert status == 200, "signup callback: {0}".format(status)
+    status, _ = browser.request("poll (data)", "GET", "/cipherwallet/" + SIGNUP_TAG)
+    assert status == 200, "signup poll: {0}".format(status)
+    # the signup form got submitted, the QR login registration gets confirmed
+    status, rp = browser.request(
+        "set_qr_login_data", "POST", "/cipherwallet/" + SIGNUP_TAG,
+        urllib.urlencode({ 'user_id': user_id }), "application/x-www-form-urlencoded"
+    )
+    assert status == 200, "registration: {0}".format(status)
+    creds = json.loads(rp)
+
+    # login: the QR code, polls, and the credentials pushed by the API
+    browser.request("qr", "GET", "/cipherwallet/{0}/qr.png".format(LOGIN_TAG))
+    session = browser.cookies["cwsession-" + LOGIN_TAG]
+    for _ in range(polls):
+        browser.request("poll (waiting)", "GET", "/cipherwallet/" + LOGIN_TAG)
+    user_ident = {
+        'cw_user': creds['cw_user'],
+        'timestamp': str(int(time.time())),
+        'nonce': uuid.uuid4().hex,
+        'hash_method': creds['hash_method'],
+    }
+    signature = "\n".join(k + "=" + user_ident[k] for k in sorted(user_ident))
+    user_ident['authorization'] = cqr.signed(
+        str(creds['secret']), creds['hash_method'], signature
+    ).replace("+", ".")
+    user_ident['session'] = session
+    constants = sys.modules["cipherwallet.constants"]
+    api_headers = cqr.auth(
+        constants.CUSTOMER_ID, constants.API_SECRET, "POST", "/cipherwallet/login",
+        user_ident, constants.H_METHOD
+    )
+    status, _ = browser.request(
+        "callback_with_data_login", "POST", "/cipherwallet/login",
+        urllib.urlencode(user_ident), "application/x-www-form-urlencoded", api_headers
+    )
+    assert status == 200, "login callback: {0}".format(status)
+    status, rp = browser.request("poll (login)", "GET", "/cipherwallet/" + LOGIN_TAG)
+    assert status == 200 and json.loads(rp) == { 'user_id': user_id }, "login poll: {0}".format(status)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p / 100.0), len(sorted_values) - 1)]
+
+
+def run_store(store, args):
+    """
+    benchmark one temp store, in this process; returns the figures for each endpoint
+    """
+    workdir = tempfile.mkdtemp(prefix="cw-bench-")
+    try:
+        install_settings(store, workdir, start_fake_api(args.api_latency / 1000.0),
+            metrics=args.metrics, memcached=args.memcached)
+        import bottle
+        from cipherwallet import api_router, cqr_auth
+        app = bottle.default_app()
+
+        per_thread = [ {} for _ in range(args.concurrency) ]
+        count = [ args.sessions ]
+        count_lock = threading.Lock()
+        failures = []
+        def worker(timings):
+            while True:
+                with count_lock:
+                    if count[0] <= 0:
+                        return
+                    count[0] -= 1
+                try:
+                    run_flow(app, cqr_auth, timings, args.polls)
+                except Exception as e:
+                    failures.append(repr(e))
+
+        # one flow to warm up the caches, the connections and the lazy imports
+        run_flow(app, cqr_auth, {}, 0)
+        threads = [ threading.Thread(target=worker, args=(t,)) for t in per_thread ]
+        t0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - t0
+
+        results = { '_elapsed': elapsed, '_failures': len(failures) }
+        for label in set(k for timings in per_thread for k in timings):
+            values = sorted(v for timings in per_thread for v in timings.get(label, []))
+            results[label] = {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'rps': len(values) / elapsed,
+            }
+        total = sum(r['count'] for k, r in results.items() if not k.startswith("_"))
+        results['_total'] = { 'count': total, 'rps': total / elapsed }
+        if failures:
+            sys.stderr.write("{0}: {1} failed flows, first: {2}\n".format(store, len(failures), failures[0]))
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(store, results, baseline=None, tolerance=None):
+    """
+    print the figures of a store, compared with the baseline if any; returns the regressions
+    """
+    def compare(label, current, base, metrics):
+        # how much worse than the baseline, in percent: slower, or fewer requests/sec
+        if not base:
+            return ""
+        worse = dict(
+            (metric, (current[metric] - base[metric]) / base[metric] * 100 * (-1 if metric == 'rps' else 1))
+            for metric in metrics if base.get(metric)
+        )
+        regressed = sorted(m for m in worse if worse[m] > tolerance)
+        if regressed:
+            regressions.append((store, label, regressed))
+        return "   vs. baseline: " + " ".join(
+            "{0} {1:+.0f}%".format(m, -worse[m] if m == 'rps' else worse[m]) for m in sorted(worse)
+        ) + ("   REGRESSION" if regressed else "")
+
+    regressions = []
+    baseline = baseline or {}
+    print("\n{0}: {1[count]} requests in {2:.2f}s, {1[rps]:.0f} requests/sec{3}{4}".format(
+        store, results['_total'], results['_elapsed'],
+        ", {0} FAILED FLOWS".format(results['_failures']) if results['_failures'] else "",
+        compare("_total", results['_total'], baseline.get('_total'), ('rps',))
+    ))
+    print("    {0:<26}{1:>8}{2:>10}{3:>10}{4:>10}".format("endpoint", "count", "p50 ms", "p99 ms", "req/s"))
+    for label in sorted(k for k in results if not k.startswith("_")):
+        r = results[label]
+        print("    {0:<26}{1[count]:>8}{1[p50_ms]:>10.3f}{1[p99_ms]:>10.3f}{1[rps]:>10.0f}{2}".format(
+            label, r, compare(label, r, baseline.get(label), ('p50_ms', 'p99_ms'))
+        ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cipherwallet web app benchmark")
+    parser.add_argument("--stores", default="memory,sessionfiles,mmap,redis",
+        help="comma separated temp stores to benchmark, out of: " + ", ".join(STORES))
+    parser.add_argument("--sessions", type=int, default=200, help="signup + login flows per store")
+    parser.add_argument("--polls", type=int, default=5, help="polls before the QR code gets scanned")
+    parser.add_argument("--concurrency", type=int, default=4, help="browsers at the same time")
+    parser.add_argument("--api-latency", type=float, default=0, help="fake API delay (milliseconds)")
+    parser.add_argument("--metrics", action="store_true", help="with METRICS_ENABLED")
+    parser.add_argument("--memcached", default="127.0.0.1:11211", help="memcached server, for 'memcached'")
+    parser.add_argument("--save", help="save the results in this JSON file")
+    parser.add_argument("--baseline", help="compare with the results saved in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=20,
+        help="percent of slowdown vs. the baseline counted as a regression (default: 20)")
+    parser.add_argument("--run-store", help=argparse.SUPPRESS)
+    parser.add_argument("--results-file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_store:
+        # the child process: benchmark one store, hand the results to the parent
+        with open(args.results_file, "w") as fh:
+            json.dump(run_store(args.run_store, args), fh)
+        # dont wait for the fake API threads still holding keep-alive connections
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+    baseline = json.load(open(args.baseline)) if args.baseline else {}
+    all_results, regressions, failed = {}, [], []
+    child_argv = argv if argv is not None else sys.argv[1:]
+    for store in args.stores.split(","):
+        results_file = tempfile.mktemp(prefix="cw-bench-", suffix=".json")
+        status = subprocess.call([
+            sys.executable, os.path.realpath(__file__),
+            "--run-store", store, "--results-file", results_file
+        ] + child_argv)
+        if status != 0 or not os.path.exists(results_file):
+            sys.stderr.write("{0}: benchmark failed\n".format(store))
+            failed.append(store)
+            continue
+        with open(results_file) as fh:
+            all_results[store] = json.load(fh)
+        os.remove(results_file)
+        regressions += report(store, all_results[store], baseline.get(store), args.tolerance)
+        if all_results[store]['_failures']:
+            failed.append(store)
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(all_results, fh, indent=2, sort_keys=True)
+    if failed:
+        print("\nfailed: {0}".format(", ".join(failed)))
+    if regressions:
+        print("\n{0} regression(s) above {1}%".format(len(regressions), args.tolerance))
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
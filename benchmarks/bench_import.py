@@ -0,0 +1,104 @@
+"""
+cold start benchmark: how long it takes a fresh process to import the cipherwallet web app
+    handlers (api_router, and with it cipherwallet_lib), and how long a warmup() takes
+    after that
+
+every measurement is a new python process, so nothing is cached in memory between them
+    (the operating system's file cache aside); the figures are medians:
+
+    python benchmarks/bench_import.py --stores memory,redis --runs 20
+
+the settings come from constants.sample.py, like in bench_flow.py; nothing gets connected
+    to, so the redis and memcached stores don't need a server (they need their client
+    libraries installed, though)
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from bench_settings import install_settings
+
+# the modules that make up most of the import time, when they get imported
+HEAVY = [ "requests", "sqlalchemy", "Crypto", "redis", "pylibmc", "bottle" ]
+
+
+def measure(store, args):
+    """
+    runs in the child process: import the handlers, then warm up, and report the timings
+        and which heavy modules got imported along the way
+    """
+    workdir = tempfile.mkdtemp(prefix="cw-bench-import-")
+    try:
+        constants = install_settings("memory", workdir, "http://127.0.0.1:1", metrics=args.metrics)
+        # set here rather than by install_settings(), that imports redis to patch it
+        constants.TMP_DATASTORE = store
+
+        t0 = time.time()
+        import cipherwallet.api_router
+        t1 = time.time()
+        imported = [ m for m in HEAVY if m in sys.modules ]
+        import cipherwallet.cipherwallet_lib as lib
+        warmup = getattr(lib, 'warmup', None)
+        if warmup is not None:
+            warmup()
+        t2 = time.time()
+        return {
+            'import': t1 - t0,
+            'warmup': t2 - t1 if warmup is not None else None,
+            'imported': imported,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[n // 2] + values[(n - 1) // 2]) / 2.0
+
+def run_store(store, args):
+    results = []
+    for _ in range(args.runs):
+        out = subprocess.check_output([
+            sys.executable, os.path.realpath(__file__), "--measure", store
+        ] + ([ "--metrics" ] if args.metrics else []))
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return results
+
+def report(store, results):
+    import_ms = median([ r['import'] for r in results ]) * 1000
+    line = "{0:14s} import {1:8.1f}ms".format(store, import_ms)
+    warmups = [ r['warmup'] for r in results if r['warmup'] is not None ]
+    if warmups:
+        line += "   warmup {0:8.1f}ms".format(median(warmups) * 1000)
+    line += "   imported: {0}".format(", ".join(results[0]['imported']) or "-")
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="cold start benchmark of the cipherwallet web app handlers")
+    parser.add_argument("--stores", default="memory,sessionfiles,mmap,redis",
+        help="comma separated temp stores to import")
+    parser.add_argument("--runs", type=int, default=10, help="processes per store")
+    parser.add_argument("--metrics", action="store_true", help="with METRICS_ENABLED")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        result = measure(args.measure, args)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+        # dont wait for the threads the library may have started
+        os._exit(0)
+
+    for store in args.stores.split(","):
+        report(store, run_store(store, args))
+
+
+if __name__ == "__main__":
+    main()
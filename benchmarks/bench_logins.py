@@ -0,0 +1,126 @@
+"""
+benchmark of the QR login credentials lookup (get_key_and_id_for_qr_login()), against a
+    scratch sqlite cw_logins table of --rows records:
+
+    python benchmarks/bench_logins.py --rows 1000000 --lookups 10000
+
+the table is first created as in the README, without an index on cw_id, and a few lookups
+    (--scan-lookups) are timed; then the index is added with the migration script in
+    cipherwallet/migrations, and the lookups are timed again, with the login credentials
+    cache turned off (every lookup goes to the database) and then on (with the looked up
+    credentials already cached); it also times the upsert of credentials
+    (set_user_data_for_qr_login()) into the full table
+the figures are per call, in microseconds
+"""
+import os
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from bench_settings import ROOT, install_settings
+
+MIGRATION = os.path.join(ROOT, "cipherwallet", "migrations", "001_cw_logins_unique_cw_id.sql")
+
+
+def fill(path, rows, secret):
+    """
+    a cw_logins table with rows records, without an index on cw_id
+    """
+    db = sqlite3.connect(path)
+    db.execute("DROP TABLE IF EXISTS cw_logins")
+    db.execute(
+        "CREATE TABLE cw_logins (user_id VARCHAR(64) PRIMARY KEY, cw_id VARCHAR(20), " +
+        "secret VARCHAR(128), reg_tag CHAR(36), hash_method VARCHAR(8), created INTEGER)"
+    )
+    now = int(time.time())
+    db.executemany(
+        "INSERT INTO cw_logins VALUES (?, ?, ?, ?, ?, ?)",
+        ( ("user{0}@example.com".format(i), "cw{0:08d}".format(i), secret, "reg-{0}".format(i), "sha256", now)
+            for i in range(rows) )
+    )
+    db.commit()
+    db.close()
+
+def migrate(path):
+    db = sqlite3.connect(path)
+    with open(MIGRATION) as f:
+        db.executescript(f.read())
+    db.commit()
+    db.close()
+
+
+def timed(f, args):
+    """
+    the time of each call of f(*arg), for every arg in args
+    """
+    times = []
+    for arg in args:
+        t0 = time.time()
+        f(*arg)
+        times.append(time.time() - t0)
+    return times
+
+def report(name, times):
+    times = sorted(times)
+    print("{0:34s} {1:7d} calls   p50 {2:9.1f}us   p99 {3:9.1f}us   mean {4:9.1f}us".format(
+        name, len(times), times[len(times) // 2] * 1e6, times[int(len(times) * 0.99)] * 1e6,
+        sum(times) / len(times) * 1e6
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark of the QR login credentials lookup")
+    parser.add_argument("--rows", type=int, default=1000000, help="records in the cw_logins table")
+    parser.add_argument("--lookups", type=int, default=10000, help="lookups with the cw_id index")
+    parser.add_argument("--scan-lookups", type=int, default=20, help="lookups without the index (0 to skip)")
+    parser.add_argument("--upserts", type=int, default=1000, help="credentials replaced")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="cw-bench-logins-")
+    try:
+        install_settings("memory", workdir, "http://127.0.0.1:1")
+        from cipherwallet import caches
+        from cipherwallet import db_interface as db
+
+        path = os.path.join(workdir, "bench.db")
+        t0 = time.time()
+        fill(path, args.rows, db.encrypt_secret("0123456789abcdef" * 4))
+        print("{0} rows written in {1:.1f}s (sqlite {2})".format(args.rows, time.time() - t0, sqlite3.sqlite_version))
+
+        rnd = random.Random(1)
+        cached = db.qr_logins
+        db.qr_logins = caches.LRUCache(0, 60)
+        if args.scan_lookups:
+            report("lookup, no cw_id index", timed(db.get_key_and_id_for_qr_login,
+                [ ("cw{0:08d}".format(rnd.randrange(args.rows)),) for _ in range(args.scan_lookups) ]))
+
+        t0 = time.time()
+        migrate(path)
+        print("cw_id index built in {0:.1f}s".format(time.time() - t0))
+        cw_ids = [ ("cw{0:08d}".format(rnd.randrange(args.rows)),) for _ in range(args.lookups) ]
+        assert db.get_key_and_id_for_qr_login(cw_ids[0][0])[0] is not None
+        report("lookup, cw_id index", timed(db.get_key_and_id_for_qr_login, cw_ids))
+        report("lookup by user id", timed(db.get_user_for_qr_login,
+            [ ("user{0}@example.com".format(rnd.randrange(args.rows)),) for _ in range(args.lookups) ]))
+        db.qr_logins = cached
+        timed(db.get_key_and_id_for_qr_login, cw_ids)
+        report("lookup, cw_id index, cached", timed(db.get_key_and_id_for_qr_login, cw_ids))
+
+        # replaced credentials: new cipherwallet ids, past the ones in the table
+        upserts = [
+            ("user{0}@example.com".format(rnd.randrange(args.rows)), {
+                'registration': "reg-new-{0}".format(i), 'cw_user': "cx{0:08d}".format(i),
+                'secret': "0123456789abcdef" * 4, 'hash_method': "sha256",
+            }) for i in range(args.upserts)
+        ]
+        assert db.set_user_data_for_qr_login(*upserts[0]) is not None
+        report("upsert", timed(db.set_user_data_for_qr_login, upserts[1:]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
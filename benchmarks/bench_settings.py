@@ -0,0 +1,60 @@
+"""
+the settings shared by the benchmarks: the constants and hooks modules the web app would
+    have, made up from the sample files
+"""
+import os
+import sys
+import imp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+USER_SECRET_ENC_KEY = "000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F"
+
+
+def install_settings(store, workdir, api_url, metrics=False, memcached="127.0.0.1:11211"):
+    """
+    the constants and hooks modules of the web app, made up for the benchmark from the
+        sample files and registered before the library gets imported, with the cw_logins
+        table in a scratch sqlite database in workdir; the cipherwallet API is at api_url,
+        metrics turns METRICS_ENABLED on and memcached is the server of the memcached store
+    """
+    constants = imp.new_module("cipherwallet.constants")
+    constants.__file__ = os.path.join(ROOT, "cipherwallet", "constants.sample.py")
+    execfile(constants.__file__, constants.__dict__)
+    constants.API_URL = api_url
+    constants.CUSTOMER_ID = "bench"
+    constants.API_SECRET = "bench-api-secret"
+    constants.POLL_DELAY = 0
+    constants.POLL_MAX_HOLD = 0
+    constants.METRICS_ENABLED = metrics
+    constants.DB_CONNECTION_STRING = "sqlite:///" + os.path.join(workdir, "bench.db")
+    constants.CW_SECRET_ENC_KEY = USER_SECRET_ENC_KEY
+    constants.TMP_DATASTORE = store
+    constants.TMPSTORE_DIR = os.path.join(workdir, "tmpstore") + "/"
+    constants.MMAP_PATH = os.path.join(workdir, "tmpstore.mmap")
+    constants.MCD_CONFIG = [ memcached ]
+    constants.REDIS_HOST, constants.REDIS_PORT, constants.REDIS_DB = "localhost", 6379, 0
+    sys.modules["cipherwallet.constants"] = constants
+
+    hooks = imp.new_module("cipherwallet.hooks")
+    hooks.get_user_id_for_current_session = lambda: None
+    hooks.authorize_session_for_user = lambda user_id: { 'user_id': user_id }
+    sys.modules["cipherwallet.hooks"] = hooks
+
+    import sqlite3
+    db = sqlite3.connect(os.path.join(workdir, "bench.db"))
+    db.execute(
+        "CREATE TABLE cw_logins (user_id VARCHAR(64) PRIMARY KEY, cw_id VARCHAR(20) UNIQUE, " +
+        "secret VARCHAR(128), reg_tag CHAR(36), hash_method VARCHAR(8), created INTEGER)"
+    )
+    db.commit()
+    db.close()
+
+    if store == "redis":
+        # the redis temp store talks to a fakeredis server in this process
+        import redis
+        import fakeredis
+        pool = fakeredis.FakeRedis().connection_pool
+        redis.ConnectionPool = redis.BlockingConnectionPool = lambda *a, **kw: pool
+    return constants
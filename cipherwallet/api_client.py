@@ -0,0 +1,162 @@
+import time
+
+import constants
+import lazy
+import metrics
+import profiling
+from constants import API_URL
+
+####  shared keep-alive connection pool for the requests to the cipherwallet API  ####
+
+# max number of connections kept open to the API (per process)
+API_POOL_SIZE = getattr(constants, 'API_POOL_SIZE', 10)
+# seconds to wait for a connection to be established, and for the API response
+API_CONNECT_TIMEOUT = getattr(constants, 'API_CONNECT_TIMEOUT', 3.05)
+API_READ_TIMEOUT = getattr(constants, 'API_READ_TIMEOUT', 10)
+# how many times an idempotent request (PUT) is retried, and the backoff factor between tries
+API_RETRIES = getattr(constants, 'API_RETRIES', 3)
+API_RETRY_BACKOFF = getattr(constants, 'API_RETRY_BACKOFF', 0.3)
+# after this many consecutive failed requests, stop calling the API for a few seconds
+API_BREAKER_THRESHOLD = getattr(constants, 'API_BREAKER_THRESHOLD', 5)
+API_BREAKER_COOLDOWN = getattr(constants, 'API_BREAKER_COOLDOWN', 30)
+
+
+
+class RequestException(Exception):
+    """
+    the request didn't get a response (network failure, timeout...); the exception raised 
+        by the requests library is in the 'cause' attribute
+    """
+
+    def __init__(self, cause):
+        Exception.__init__(self, str(cause))
+        self.cause = cause
+
+
+class CircuitBreaker(object):
+    """
+    counts consecutive failures; when there are too many, it "opens" for a cool-down 
+        period, during which the callers should not even try to reach the API
+    after the cool-down, one more failure is enough to open it again
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = lazy.Lock()
+
+    def closed(self):
+        return time.time() >= self.open_until
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.open_until = time.time() + self.cooldown
+                    self.failures = self.threshold - 1
+
+breaker = CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_COOLDOWN)
+
+
+def _retry_policy():
+    """
+    retry PUTs on connection errors and on gateway errors, with exponential backoff
+    POSTs create a new QR code on every call, so they are only retried when the
+        connection couldn't be established at all
+    """
+    try:
+        from urllib3.util.retry import Retry
+    except ImportError:
+        from requests.packages.urllib3.util.retry import Retry
+    options = dict(
+        total=API_RETRIES, backoff_factor=API_RETRY_BACKOFF,
+        status_forcelist=[502, 503, 504], raise_on_status=False
+    )
+    try:
+        return Retry(allowed_methods=frozenset(["PUT"]), **options)
+    except TypeError:
+        # urllib3 older than 1.26
+        return Retry(method_whitelist=frozenset(["PUT"]), **options)
+
+def _new_session():
+    # requests sessions are safe to share between threads as long as their settings
+    #    dont change; the connection pool underneath is thread safe
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount(API_URL, HTTPAdapter(
+        pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=_retry_policy()
+    ))
+    return session
+
+# requests gets imported, and the session created, with the first request to the API
+api = lazy.LazyResource(_new_session)
+
+
+def _send(method, resource, **kwargs):
+    # server errors and network failures count against the circuit breaker
+    session = api()
+    try:
+        rp = session.request(
+            method, API_URL + resource, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT), **kwargs
+        )
+    except Exception as e:
+        import requests
+        if not isinstance(e, requests.RequestException):
+            raise
+        breaker.record(False)
+        raise RequestException(e)
+    breaker.record(rp.status_code < 500)
+    if metrics.METRICS_ENABLED:
+        metrics.count("api_responses", method=method, status=rp.status_code)
+    return rp
+
+
+def available():
+    """
+    False while the circuit breaker is open, i.e. the API failed repeatedly just now
+    """
+    return breaker.closed()
+
+
+@metrics.timed("api_request", method="POST")
+@profiling.spanned("api.post")
+def post(resource, headers, data):
+    """
+    POST a request to the cipherwallet API, over one of the pooled connections
+    """
+    return _send("POST", resource, headers=headers, data=data)
+
+
+@metrics.timed("api_request", method="PUT")
+@profiling.spanned("api.put")
+def put(resource, headers):
+    """
+    PUT a request to the cipherwallet API, over one of the pooled connections
+    """
+    return _send("PUT", resource, headers=headers)
+
+
+def pool_stats():
+    """
+    connection reuse counters for the pool; 'reused' should grow much faster than
+        'connections' when the pool is doing its job
+    """
+    connections = requests_sent = 0
+    pools = api().get_adapter(API_URL).poolmanager.pools if api.created() else {}
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return {
+        'connections': connections,
+        'requests': requests_sent,
+        'reused': max(0, requests_sent - connections),
+        'pool_size': API_POOL_SIZE,
+    }
@@ -1,12 +1,57 @@
 import time
 import bottle
+import functools
 
 from cqr_auth import verify
 import cipherwallet_lib
+import metrics
+import profiling
 from cipherwallet_lib import CipherwalletError
 from constants import CW_SESSION_TIMEOUT
 
+def _measured(handler):
+    """
+    times a route handler and counts its responses by http status, when the metrics are enabled
+    """
+    if not metrics.METRICS_ENABLED:
+        return handler
+    name = handler.__name__.lstrip("_")
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        t0 = time.time()
+        status = 500
+        try:
+            rp = handler(*args, **kwargs)
+            status = bottle.response.status_code
+            return rp
+        except bottle.HTTPResponse as response:
+            status = response.status_code
+            raise
+        finally:
+            metrics.observe("http_request", time.time() - t0, handler=name)
+            metrics.count("http_responses", handler=name, status=status)
+    return wrapper
+
+def _measured_stream(name, stream):
+    """
+    times a streamed response, from its start until it ends or the browser goes away, when
+        the metrics are enabled; the handler itself only sets the stream up
+    """
+    if not metrics.METRICS_ENABLED:
+        return stream
+    def wrapper():
+        t0 = time.time()
+        try:
+            for chunk in stream:
+                yield chunk
+        finally:
+            metrics.observe("http_stream", time.time() - t0, handler=name)
+    return wrapper()
+
+
 @bottle.get('/cipherwallet/login')
+@_measured
+@profiling.traced
 def _check_login():
     """
     accepts callbacks with no data from the cipherwallet API; these calls verify the availability 
@@ -23,6 +68,8 @@ def _check_login():
 
 
 @bottle.post('/cipherwallet/login')
+@_measured
+@profiling.traced
 def _callback_with_data_login():
     """
     login callback requests come from the cipherwallet API server and they're signed with
@@ -48,6 +95,8 @@ def _callback_with_data_login():
         
 
 @bottle.get('/cipherwallet/<operation:re:signup|checkout|reg>')
+@_measured
+@profiling.traced
 def _check(operation):
     """
     accepts callbacks with no data from the cipherwallet API; these calls verify the availability 
@@ -57,6 +106,8 @@ def _check(operation):
 
 
 @bottle.post('/cipherwallet/<operation:re:signup|checkout|reg>')
+@_measured
+@profiling.traced
 def _callback_with_data(operation):
     """
     accepts callbacks containing data from the mobile app and places it temporarily in the 
@@ -73,7 +124,22 @@ def _callback_with_data(operation):
         bottle.abort(400, "Bad Request")
 
 
+@bottle.get('/cipherwallet/metrics')
+def _metrics():
+    """
+    the SDK counters and timers, in the prometheus text format; 404 unless METRICS_ENABLED is set
+    the numbers are not secret, but you'd rather not publish them: restrict the access to 
+        this URL to your monitoring system
+    """
+    if not metrics.METRICS_ENABLED:
+        bottle.abort(404, "Not Found")
+    bottle.response.content_type = "text/plain; version=0.0.4"
+    return metrics.render()
+
+
 @bottle.get('/cipherwallet/<tag>/qr.png')
+@_measured
+@profiling.traced
 def _qr(tag):
     """
     AJAX request for cipherwallet QR code
@@ -95,6 +161,8 @@ def _qr(tag):
 
 
 @bottle.get('/cipherwallet/<tag>')
+@_measured
+@profiling.traced
 def _poll(tag):
     """
     AJAX polling for the status of a page awaiting QR code scanning
@@ -104,11 +172,35 @@ def _poll(tag):
     try:
         bottle.response.content_type = "application/json"
         return cipherwallet_lib.poll(tag, bottle.request.get_cookie("cwsession-" + tag))
+    except CipherwalletError as cwex:
+        # bottle.abort() can't add headers, and the "waiting" responses carry a Retry-After
+        raise bottle.HTTPError(cwex.http_status, cwex.http_desc, headers=cwex.headers)
+
+
+@bottle.get('/cipherwallet/<tag>/events')
+def _events(tag):
+    """
+    server-sent events stream for a page awaiting QR code scanning, used by cipherwallet.js 
+        instead of the polling when the browser supports it; it announces when the data is 
+        ready to be picked up by a regular poll. each open stream keeps a connection busy 
+        until the QR code gets scanned or expires, so use an async web server for this
+    not timed or traced like the other routes, since the handler returns before the stream 
+        starts; the stream gets timed on its own
+    """
+    try:
+        stream = cipherwallet_lib.events(tag, bottle.request.get_cookie("cwsession-" + tag))
     except CipherwalletError as cwex:
         bottle.abort(cwex.http_status, cwex.http_desc)
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    # keep nginx from buffering the stream
+    bottle.response.set_header("X-Accel-Buffering", "no")
+    return _measured_stream("events", stream)
 
 
 @bottle.post('/cipherwallet/<tag>')
+@_measured
+@profiling.traced
 def _set_qr_login_data(tag=None):
     """
     when the user presses (in the browser) the submit button on a signup form, the web app would 
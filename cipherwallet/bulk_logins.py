@@ -0,0 +1,88 @@
+import sys
+import csv
+import time
+import argparse
+
+import db_interface as db
+
+####  command line tool for bulk changes of the cw_logins table  ####
+"""
+Provision or revoke cipherwallet QR logins for lots of users at once, for example when
+migrating the users of a whole tenant. Records are read from a file (or from stdin) and
+written to the database in chunks, one transaction per chunk.
+
+    cw-logins provision [FILE]    each line: user_id,cw_id,secret,reg_tag[,hash_method]
+    cw-logins revoke [FILE]       each line: user_id
+
+The secrets are expected in plain text; they get encrypted the same way as the ones
+saved by the SDK.
+"""
+
+# how often (seconds) the progress gets reported
+REPORT_INTERVAL = 5
+
+
+class Progress(object):
+    """
+    counts the records streaming thru, and reports the rate on stderr
+    """
+
+    def __init__(self, action):
+        self.action = action
+        self.count = 0
+        self.started = self.reported = time.time()
+
+    def __call__(self, records):
+        for record in records:
+            self.count += 1
+            if time.time() - self.reported >= REPORT_INTERVAL:
+                self.report()
+            yield record
+
+    def report(self, rows=None):
+        self.reported = time.time()
+        rate = self.count / max(self.reported - self.started, 1e-6)
+        sys.stderr.write("{0} rows read, {1:.0f} rows/sec{2}\n".format(
+            self.count, rate, "" if rows is None else ", {0} rows {1}".format(rows, self.action)
+        ))
+
+
+def _logins(lines):
+    for row in csv.reader(lines):
+        if not row or not row[0].strip():
+            continue
+        extra_data = { 'cw_user': row[1], 'secret': row[2], 'registration': row[3] }
+        if len(row) > 4 and row[4]:
+            extra_data['hash_method'] = row[4]
+        yield row[0], extra_data
+
+
+def _user_ids(lines):
+    for line in lines:
+        if line.strip():
+            yield line.strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cw-logins", description="bulk provisioning / revocation of cipherwallet QR logins"
+    )
+    parser.add_argument("action", choices=["provision", "revoke"])
+    parser.add_argument("file", nargs="?", type=argparse.FileType("r"), default=sys.stdin,
+        help="input file (default: stdin)")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+        help="records per transaction (default: 1000)")
+    args = parser.parse_args(argv)
+
+    if args.action == "provision":
+        progress = Progress("provisioned")
+        rows = db.set_user_data_for_qr_login_bulk(progress(_logins(args.file)), args.chunk_size)
+    else:
+        progress = Progress("revoked")
+        rows = db.remove_users_for_qr_login_bulk(progress(_user_ids(args.file)), args.chunk_size)
+    progress.report(rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import sys
+import time
+import collections
+
+import lazy
+
+####  small in-process caches  ####
+
+
+class ExpiringSet(object):
+    """
+    a bounded set of keys with a time-to-live, used to remember things like nonces
+    keys are grouped in time buckets; when a bucket expires, or when the set grows larger
+        than max_keys, the oldest bucket is dropped as a whole
+    keys may be remembered for up to bucket_seconds longer than their time-to-live; the
+        time-to-live should be about the same for all the keys, since buckets are expired
+        in the order they were created
+    """
+
+    def __init__(self, bucket_seconds=60, max_keys=100000):
+        self.bucket_seconds = bucket_seconds
+        self.max_keys = max_keys
+        self.buckets = collections.OrderedDict()    # bucket number -> list of keys
+        self.index = {}                             # key -> bucket number
+        self.hits = 0
+        self.misses = 0
+        self.lock = lazy.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            self._evict(time.time())
+            if key in self.index:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key, ttl):
+        """
+        remember the key for ttl seconds; return False if it was already there
+        """
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            if key in self.index:
+                return False
+            bucket = int((now + ttl) / self.bucket_seconds) + 1
+            if bucket not in self.buckets:
+                self.buckets[bucket] = []
+            self.buckets[bucket].append(key)
+            self.index[key] = bucket
+            return True
+
+    def _evict(self, now):
+        current = int(now / self.bucket_seconds)
+        while self.buckets:
+            bucket = next(iter(self.buckets))
+            if bucket > current and len(self.index) < self.max_keys:
+                break
+            for key in self.buckets.pop(bucket):
+                if self.index.get(key) == bucket:
+                    del self.index[key]
+
+    def stats(self):
+        """
+        hit rate and approximate memory footprint, in bytes
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            footprint = sys.getsizeof(self.index) + sys.getsizeof(self.buckets) + sum(
+                sys.getsizeof(keys) for keys in self.buckets.values()
+            ) + sum(sys.getsizeof(key) for key in self.index)
+            return {
+                'keys': len(self.index),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'bytes': footprint,
+            }
+
+
+class LRUCache(object):
+    """
+    a bounded map of keys to values, where values also expire after ttl seconds
+    when full, the least recently used key is dropped; keys may be grouped (for example
+        by the user they belong to), such that a whole group can be discarded at once
+    a value read from somewhere else while its group gets discarded (because it changed 
+        there) may be stale: take a generation() before reading it, and pass it to set(), 
+        that doesn't cache the value if its group was discarded since
+    """
+
+    def __init__(self, max_items=10000, ttl=60):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = collections.OrderedDict()      # key -> (expiration, group, value)
+        self.groups = {}                            # group -> set of keys
+        self.discards = 0
+        self.discarded = collections.OrderedDict()  # group -> discards count when last discarded
+        self.forgotten = 0                          # discards count of the last group dropped from there
+        self.hits = 0
+        self.misses = 0
+        self.lock = lazy.Lock()
+
+    def get(self, key):
+        """
+        the value cached for key, or None if not there (or expired)
+        """
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    self._ungroup(key, item[1])
+                self.misses += 1
+                return None
+            # re-insert, to mark as most recently used
+            self.items[key] = item
+            self.hits += 1
+            return item[2]
+
+    def generation(self):
+        """
+        a mark to pass to set(), taken before reading the value to cache
+        """
+        return self.discards
+
+    def set(self, key, value, group=None, since=None):
+        """
+        cache a value; with since (a generation()), only if its group wasn't discarded since
+        returns whether the value got cached
+        """
+        with self.lock:
+            if since is not None and (
+                since < self.forgotten or self.discarded.get(group, -1) > since
+            ):
+                return False
+            old = self.items.pop(key, None)
+            if old is not None:
+                self._ungroup(key, old[1])
+            self.items[key] = (time.time() + self.ttl, group, value)
+            if group is not None:
+                self.groups.setdefault(group, set()).add(key)
+            while len(self.items) > self.max_items:
+                old_key, old = self.items.popitem(last=False)
+                self._ungroup(old_key, old[1])
+            return True
+
+    def discard_group(self, group):
+        """
+        forget all the keys in a group
+        """
+        with self.lock:
+            for key in self.groups.pop(group, ()):
+                self.items.pop(key, None)
+            self.discards += 1
+            self.discarded.pop(group, None)
+            self.discarded[group] = self.discards
+            # only the recent discards matter, to the reads still going on
+            while len(self.discarded) > self.max_items:
+                _, self.forgotten = self.discarded.popitem(last=False)
+
+    def _ungroup(self, key, group):
+        if group is not None and group in self.groups:
+            self.groups[group].discard(key)
+            if not self.groups[group]:
+                del self.groups[group]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'items': len(self.items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
@@ -16,15 +16,20 @@ function Cipherwallet(options) {
 	//     410 = offer expired
 	//       0 = any other screwed up error
 	this.onFailure = options.onFailure || function(x) {}; 
+	// wait for the data with server-sent events instead of polling, where the browser can do it
+	this.useEvents = options.useEvents && !!window.EventSource;
+	// the longest pause (milliseconds) between two polls, whatever the server suggests
+	this.maxPollDelay = options.maxPollDelay || 10000;
+	this.pollDelay = 0;
 	this.polls = true;
 	all_cw_codes[this.tag] = this;
-	// populate the div that will display the QR code, and activate the longPoll() loop
+	// populate the div that will display the QR code, and start waiting for the data
 	// when the image download completes
 	this.qrContainer.innerHTML =
 		'<a href="' + this.detailsURL + '">' +
 		'<img ' + 
 		    'src="/cipherwallet/' + this.tag + '/qr.png?_=' + Date.now() + '" ' +
-		    'onload="all_cw_codes[\'' + this.tag + '\'].longPoll()" ' +
+		    'onload="all_cw_codes[\'' + this.tag + '\'].start()" ' +
 		'/>' +
 		'<p>What\'s this?</p>' +
 		'</a>'
@@ -32,6 +37,38 @@ function Cipherwallet(options) {
 
 }	
 
+Cipherwallet.prototype.start = function() {
+// wait for data to be received from the mobile app
+    if (this.useEvents)
+        this.listen();
+    else
+        this.longPoll();
+};
+
+Cipherwallet.prototype.listen = function() {
+// wait for the server to announce that the data from the mobile app arrived, then pick it up 
+// with a regular poll; if the event stream fails, fall back to polling
+    if (!this.polls)
+        return;
+    var this_tag = this.tag;
+    var events = new EventSource("/cipherwallet/" + this_tag + "/events");
+    this.events = events;
+    events.addEventListener("ready", function() {
+        events.close();
+        all_cw_codes[this_tag].longPoll();
+    });
+    events.addEventListener("expired", function() {
+        events.close();
+        all_cw_codes[this_tag].qrContainer.style.display = "none"; 
+        all_cw_codes[this_tag].polls = false; 
+        all_cw_codes[this_tag].onFailure(410); 
+    });
+    events.onerror = function() {
+        events.close();
+        all_cw_codes[this_tag].longPoll();
+    };
+};
+
 Cipherwallet.prototype.longPoll = function() {
 // continuously poll the AJAX server waiting for data to be received from the mobile app
     if (!this.polls)
@@ -56,7 +93,15 @@ Cipherwallet.prototype.longPoll = function() {
             // also call the onFailure() function
             all_cw_codes[this_tag].onFailure(xhr.status); 
         },
-        complete: function() { all_cw_codes[this_tag].longPoll(); }, 
+        complete: function(xhr) { 
+            // the server tells how long to wait before polling again; follow it, but let the 
+            // pause no more than double from one poll to the next, and cap it
+            var cw = all_cw_codes[this_tag];
+            var hint = parseInt(xhr.getResponseHeader("Retry-After"), 10);
+            cw.pollDelay = isNaN(hint) ? 0 : 
+                Math.min(hint * 1000, Math.max(2 * cw.pollDelay, 1000), cw.maxPollDelay);
+            setTimeout(function() { cw.longPoll(); }, cw.pollDelay);
+        }, 
         timeout: 10000 
     });
 };
@@ -64,6 +109,8 @@ Cipherwallet.prototype.longPoll = function() {
 Cipherwallet.prototype.stop = function() {
 // stop polling
     this.polls = false;
+    if (this.events)
+        this.events.close();
     this.qrContainer.innerHTML = "";
 };
 
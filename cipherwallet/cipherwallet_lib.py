@@ -1,69 +1,97 @@
 import os
 import re
+import sys
 import time
 import json
+import math
 import random
-import requests
-import importlib
 import traceback
 
 from constants import *
 import db_interface as db
 import cqr_auth as cqr
+import api_client
+import qr_pool
+import tmpstore
 import hooks
+import lazy
+import metrics
+import profiling
+import constants
 
-tmp_datastore = importlib.import_module("cipherwallet.tmpstore_{0}".format(TMP_DATASTORE), package=None)
+def _async_worker():
+    """
+    whether gevent or eventlet made the sockets cooperative, so that a parked request 
+        doesn't hold on to a thread
+    """
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    if gevent_monkey is not None and gevent_monkey.is_module_patched("socket"):
+        return True
+    eventlet_patcher = sys.modules.get("eventlet.patcher")
+    return eventlet_patcher is not None and eventlet_patcher.is_monkey_patched("socket")
+
+# how long (in seconds) can a poll request be parked waiting for the user data to arrive; 
+#    unless set, only with an async web server worker: with a sync one, a parked poll holds 
+#    on to a worker
+POLL_MAX_HOLD = getattr(constants, 'POLL_MAX_HOLD', 8 if _async_worker() else 0)
+# how often (in seconds) an event stream sends something, so that proxies don't close it
+EVENTS_KEEPALIVE = getattr(constants, 'EVENTS_KEEPALIVE', 15)
+# a poll that finds nothing tells the browser (in a Retry-After header) to wait before the next 
+#    one: POLL_RETRY_MIN seconds while the QR code is fresh, twice as long for every 
+#    POLL_RETRY_STEP seconds of its age, up to POLL_RETRY_MAX seconds
+POLL_RETRY_MIN = getattr(constants, 'POLL_RETRY_MIN', 1)
+POLL_RETRY_STEP = getattr(constants, 'POLL_RETRY_STEP', 30)
+POLL_RETRY_MAX = getattr(constants, 'POLL_RETRY_MAX', 8)
+
+# served instead of the QR code when the cipherwallet API doesn't deliver one
+with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "1x1.png"), "rb") as fh:
+    FALLBACK_PNG = fh.read()
+
+# the temp store backend gets imported on first use
+tmp_datastore = lazy.LazyResource(tmpstore.load)
 
 class CipherwalletError(Exception):
 
-    def __init__(self, http_status=500, http_desc="Internal Server Error"):
+    def __init__(self, http_status=500, http_desc="Internal Server Error", headers=None):
         Exception.__init__(self, "{0} {1}".format(str(http_status), http_desc))
         self.http_status = http_status
         self.http_desc = http_desc
+        self.headers = headers or {}
         
 
-def qr(tag):
+# default timeout values, do not modify because they must stay in sync with the API
+DEFAULT_TTL = {
+    OP_SIGNUP: 120,
+    OP_LOGIN: 60,
+    OP_CHECKOUT: 300,
+    OP_REGISTRATION: 30,
+}
+
+def _request_qr(tag, rq_def, user_id=None):
     """
-    called by an AJAX request for cipherwallet QR code
-    this action is typically invoked by your web page containing the form, thru the code 
-        in cipherwallet.js, to obtain the image with the QR code to display
-    it will return the image itself, with an 'image/png' content type, so you can use 
-        the URL to this page as a 'src=...' attribute for the <img> tag
+    creates a new cipherwallet session for a QR code tag, and obtains the QR code image 
+        for it from the cipherwallet API
+    returns the image (None if the API didn't deliver one), the session identifier and 
+        the session expiration time
     """
-
-    # default timeout values, do not modify because they must stay in sync with the API
-    DEFAULT_TTL = {
-        OP_SIGNUP: 120,
-        OP_LOGIN: 60,
-        OP_CHECKOUT: 300,
-        OP_REGISTRATION: 30,
-    }
-
     # create an unique session identifier, 8 random characters, and postfix it with the QR code tag
     # the qr code tag is useful to distinguish multiple QR codes on the same page
-    if re.compile("[a-zA-Z0-9.:_-]+").match(tag) is None:
-        raise CipherwalletError(400, "Bad request")
     cw_session = "".join(random.choice(ALPHABET) for _ in range(8)) + "-" + tag
-    
-    # get the user data request template; templates for each type of request are pre-formatted 
-    #    and stored in the constants file, in the qr_requests variable
-    try:
-        rq_def = qr_requests[tag]
-    except Exception:
-        raise CipherwalletError(501, "Not implemented")
+
+    # while the API is failing, dont bother it (and dont save the session, so that the 
+    #    browser polls end quickly with an "expired" status)
+    if not api_client.available():
+        return None, cw_session, None
 
     # set the time-to-live of the cipherwallet session in the temporary storage
     cw_session_ttl = rq_def.get('qr_ttl', DEFAULT_TTL[rq_def['operation']])
-    if tmp_datastore.cw_session_data(cw_session, 'qr_expires', 1 + cw_session_ttl + int(time.time())) is None:
-        raise CipherwalletError(500, "Internal server error")
-
+    cw_session_expires = 1 + cw_session_ttl + int(time.time())
+    session_vars = { 'qr_expires': cw_session_expires }
     # for registration QR code requests, we also save the current user ID in the short term storage
-    if rq_def['operation'] == OP_REGISTRATION:
-        uid = hooks.get_user_id_for_current_session() # you MUST implement this function in hooks.py
-        if uid is None:  
-            raise CipherwalletError(401, "Unauthorized")
-        else:
-            tmp_datastore.cw_session_data(cw_session, 'user_id', uid);
+    if user_id is not None:
+        session_vars['user_id'] = user_id
+    if tmp_datastore.cw_session_update(cw_session, **session_vars) is None:
+        raise CipherwalletError(500, "Internal server error")
 
     # prepare request to the API
     method = "POST";
@@ -87,45 +115,210 @@ def qr(tag):
     api_rq_headers['Content-Type'] = "application/x-www-form-urlencoded";
     #api_rq_headers['Content-Length'] = len(request_params);
 
-    # get the QR image from the API and send it right back to the browser
-    api_rp = requests.post(API_URL + resource, headers=api_rq_headers, data=request_params)
-    content = api_rp.content if api_rp.status_code == 200 \
-        else open(os.path.dirname(os.path.realpath(__file__)) + "/1x1.png").read()
-    return content, cw_session
+    # get the QR image from the API
+    try:
+        api_rp = api_client.post(resource, api_rq_headers, request_params)
+    except api_client.RequestException:
+        return None, cw_session, cw_session_expires
+    return (api_rp.content if api_rp.status_code == 200 else None), cw_session, cw_session_expires
 
-def poll(tag, cw_session_id=None):
+def _pregenerate_qr(tag):
     """
-    AJAX polling for the status of a page awaiting QR code scanning
-    this action is typically invoked periodically by the browser, thru the code in cipherwallet.js, 
-        in order to detect when / if the user scanned the QR code and transmitted the expected info
+    QR code factory for the pre-generation pool; drops the images that didn't make it
     """
-    # we look for the presence of requested info associated with the data in the storage place
-    session_cookie_name = "cwsession-" + tag
-    if cw_session_id is None:
-        raise CipherwalletError(410, "Offer expired")
+    png, cw_session, cw_session_expires = _request_qr(tag, qr_requests[tag])
+    return (png, cw_session, cw_session_expires) if png is not None else None
 
-    session_expires_on = tmp_datastore.cw_session_data(cw_session_id, 'qr_expires')
+# QR codes that dont depend on the browser session (i.e. not for registrations, and without 
+#    a display message computed on the fly) can be prepared ahead of time, if the service 
+#    descriptor sets a 'pool_depth'
+pregenerated_qr = qr_pool.QRPool(_pregenerate_qr, dict(
+    (tag, rq_def['pool_depth']) for tag, rq_def in qr_requests.items()
+    if rq_def.get('pool_depth') and rq_def['operation'] != OP_REGISTRATION 
+        and not hasattr(rq_def.get('display'), '__call__')
+))
+
+# the stats of the pools and caches, exported with the metrics as gauges
+metrics.add_collector("api_pool", api_client.pool_stats)
+metrics.add_collector("api_breaker", lambda: { 'open': not api_client.available() })
+metrics.add_collector("db_pool", db.db_pool_stats)
+metrics.add_collector("nonce_cache", db.nonce_cache_stats)
+metrics.add_collector("login_cache", db.login_cache_stats)
+metrics.add_collector("qr_pool", pregenerated_qr.stats, label="tag")
+
+
+def warmup(database=True):
+    """
+    import the heavy modules and create the clients that are otherwise created on first use:
+        the temp store client, the cipherwallet API session, the crypto modules and (unless 
+        database is False) the database engine; no connections are opened
+    a pre-fork server can call this in the parent process, so that the workers don't each 
+        pay for it
+    """
+    backend = tmp_datastore()
+    if callable(getattr(backend, 'warmup', None)):
+        backend.warmup()
+    api_client.api()
+    db.warmup(database)
+
+def qr(tag):
+    """
+    called by an AJAX request for cipherwallet QR code
+    this action is typically invoked by your web page containing the form, thru the code 
+        in cipherwallet.js, to obtain the image with the QR code to display
+    it will return the image itself, with an 'image/png' content type, so you can use 
+        the URL to this page as a 'src=...' attribute for the <img> tag
+    """
+    if re.compile("[a-zA-Z0-9.:_-]+").match(tag) is None:
+        raise CipherwalletError(400, "Bad request")
+    
+    # get the user data request template; templates for each type of request are pre-formatted 
+    #    and stored in the constants file, in the qr_requests variable
+    try:
+        rq_def = qr_requests[tag]
+    except Exception:
+        raise CipherwalletError(501, "Not implemented")
+
+    uid = None
+    if rq_def['operation'] == OP_REGISTRATION:
+        uid = hooks.get_user_id_for_current_session() # you MUST implement this function in hooks.py
+        if uid is None:  
+            raise CipherwalletError(401, "Unauthorized")
+    else:
+        # use a ready-made QR code, if we have one
+        pooled = pregenerated_qr.take(tag)
+        if pooled is not None:
+            # the code has been waiting in the pool; for the poll pacing, its age counts from now
+            tmp_datastore.cw_session_update(pooled[1], qr_served=int(time.time()))
+            return pooled
+
+    # get the QR image from the API and send it right back to the browser
+    png, cw_session, _ = _request_qr(tag, rq_def, uid)
+    return png or FALLBACK_PNG, cw_session
+
+def _poll_result(cw_session_id):
+    """
+    one look at the temporary storage for a given session: returns the expiration time of 
+        the session, the time a pooled QR code was handed out (or None) and the poll response, 
+        or None as a response if the user didn't scan the QR code yet
+    """
+    session_expires_on, user_data_json, user_ident_json, served = tmp_datastore.poll_snapshot(cw_session_id)
     if session_expires_on is None or session_expires_on < time.time():
         raise CipherwalletError(410, "Offer expired")
 
-    user_data_json = tmp_datastore.get_user_data(cw_session_id)
     if user_data_json is not None:
         # QR scan data is present, submit it as AJAX response
-        return user_data_json
+        return session_expires_on, served, user_data_json
 
-    user_ident_json = tmp_datastore.get_user_ident(cw_session_id)
     if user_ident_json is not None:
         # this is user data for the login service
         # if the user signature was hashed properely, we can declare the user logged in
         user_id = cqr.authorize(json.loads(user_ident_json))
         if user_id is not None:
             # you MUST implement the function below in hooks.py
-            return hooks.authorize_session_for_user(user_id) or { 'error': "User not registered" }
+            with profiling.span("hooks.authorize_session_for_user"):
+                rp = hooks.authorize_session_for_user(user_id)
+            return session_expires_on, served, rp or { 'error': "User not registered" }
         else:
             raise CipherwalletError(401, "Unauthorized")
 
-    time.sleep(POLL_DELAY)
-    raise CipherwalletError(202, "Waiting For User")
+    return session_expires_on, served, None
+
+def poll(tag, cw_session_id=None):
+    """
+    AJAX polling for the status of a page awaiting QR code scanning
+    this action is typically invoked periodically by the browser, thru the code in cipherwallet.js, 
+        in order to detect when / if the user scanned the QR code and transmitted the expected info
+    """
+    # we look for the presence of requested info associated with the data in the storage place
+    if cw_session_id is None:
+        raise CipherwalletError(410, "Offer expired")
+
+    started = time.time()
+    session_expires_on, served, rp = _poll_result(cw_session_id)
+    if rp is None:
+        # temp stores that can signal new data let us hold the request until the data lands 
+        #    (or for POLL_MAX_HOLD seconds); the others answer soon, and the browser waits 
+        #    as long as the Retry-After header says before the next poll
+        held = False
+        wait_for_user_data = getattr(tmp_datastore, 'wait_for_user_data', None)
+        if wait_for_user_data is not None and POLL_MAX_HOLD > 0:
+            hold = min(POLL_MAX_HOLD, session_expires_on - time.time())
+            if hold > 0:
+                held = True
+                if wait_for_user_data(cw_session_id, hold):
+                    session_expires_on, served, rp = _poll_result(cw_session_id)
+        if not held:
+            # but not right away: the browsers still running an older (cached) cipherwallet.js 
+            #    ignore Retry-After, and would poll again at once
+            delay = min(POLL_DELAY, session_expires_on - time.time())
+            if delay > 0:
+                time.sleep(delay)
+    if rp is None:
+        raise CipherwalletError(202, "Waiting For User", {
+            'Retry-After': str(_retry_after(
+                tag, served, session_expires_on - time.time(), time.time() - started
+            ))
+        })
+    return rp
+
+def _retry_after(tag, served, remaining, waited=0):
+    """
+    how long (whole seconds) should the browser wait before polling again, given how long 
+        ago the QR code was handed out and how long it has left to live; the codes that 
+        weren't scanned in the first seconds are likely never to be scanned, so their polls 
+        can slow down. the time the poll already waited on this side counts too
+    """
+    rq_def = qr_requests.get(tag)
+    ttl = rq_def.get('qr_ttl', DEFAULT_TTL[rq_def['operation']]) if rq_def else 0
+    age = max(ttl - remaining, 0)
+    if served is not None:
+        # a pooled code's session was created before the code was handed out; the ones 
+        #    generated on the spot (when the pool ran dry) dont have this
+        age = max(time.time() - served, 0)
+    hint = math.ceil(min(POLL_RETRY_MIN * 2 ** int(age / POLL_RETRY_STEP), POLL_RETRY_MAX) - waited)
+    # but dont sleep past the expiration, the page should learn about it soon; and not less 
+    #    than a second either
+    return int(max(min(hint, remaining), 1))
+
+
+def events(tag, cw_session_id=None):
+    """
+    server-sent events alternative to the polling: returns a generator of events for the 
+        browser, telling when the user data for the session arrived ("ready"; the browser then 
+        makes one regular poll to pick it up) or when the session expired ("expired")
+    the data itself doesn't travel over the stream, because picking up a login may need to 
+        set cookies, and a response that already started streaming can't set them anymore
+    only for the temp stores that can announce new data (wait_for_user_data()); with the 
+        others, a stream would have to read the store over and over, so there is none (404), 
+        and the browser falls back to polling
+    """
+    if getattr(tmp_datastore, 'wait_for_user_data', None) is None:
+        raise CipherwalletError(404, "Not Found")
+    if cw_session_id is None:
+        raise CipherwalletError(410, "Offer expired")
+    session_expires_on = tmp_datastore.cw_session_data(cw_session_id, 'qr_expires')
+    if session_expires_on is None or session_expires_on < time.time():
+        raise CipherwalletError(410, "Offer expired")
+    return _event_stream(cw_session_id)
+
+def _event_stream(cw_session_id):
+    # how soon should the browser reconnect if the stream breaks
+    yield "retry: {0}\n\n".format(int(POLL_DELAY * 1000))
+    last_sent = time.time()
+    while True:
+        session_expires_on, user_data_json, user_ident_json, _ = tmp_datastore.poll_snapshot(cw_session_id)
+        if session_expires_on is None or session_expires_on < time.time():
+            yield "event: expired\ndata: 410\n\n"
+            return
+        if user_data_json is not None or user_ident_json is not None:
+            yield "event: ready\ndata: 200\n\n"
+            return
+        tmp_datastore.wait_for_user_data(cw_session_id, max(min(EVENTS_KEEPALIVE, session_expires_on - time.time()), 0))
+        if time.time() - last_sent >= EVENTS_KEEPALIVE:
+            # a comment line; writing it is also how we find out that the browser went away
+            yield ": keepalive\n\n"
+            last_sent = time.time()
 
 
 def set_qr_login_data(tag, user_id, cw_session_id=None):
@@ -150,7 +343,7 @@ def set_qr_login_data(tag, user_id, cw_session_id=None):
     method = "PUT"
     resource = "/reg/{0}".format(reg_data['registration'])
     api_rq_headers = cqr.auth(CUSTOMER_ID, API_SECRET, method, resource, "", H_METHOD)
-    api_rp = requests.put(API_URL + resource, headers=api_rq_headers)
+    api_rp = api_client.put(resource, api_rq_headers)
     if api_rp.status_code == 200:
         # confirmed with the cipherwallet API, we just have to save the credentials 
         #    in the permanent storage now
@@ -207,7 +400,7 @@ def callback_with_data(operation, rq):
         method = "PUT"
         resource = "/reg/{0}".format(reg_tag)
         api_rq_headers = cqr.auth(CUSTOMER_ID, API_SECRET, method, resource, "", H_METHOD)
-        api_rp = requests.put(API_URL + resource, headers=api_rq_headers)
+        api_rp = api_client.put(resource, api_rq_headers)
         if api_rp.status_code == 200:
             # create and save a set of new cipherwallet credentials in permanent storage
             cw_user_data = db.create_cipherwallet_user(reg_tag)
@@ -0,0 +1,81 @@
+import json
+import zlib
+
+import constants
+import lazy
+
+####  encoding of the values kept in the temp stores  ####
+"""
+The temp stores that keep their data outside of the web app process (redis, memcached, the
+memory-mapped file and the plaintext files) save the cipherwallet sessions, the data posted
+by the mobile app and the signup registrations as encode()d strings, and read them back with
+decode(). With TMPSTORE_CODEC = 'json' (the default) a value is the JSON text, as it always
+was; with 'msgpack', it's the (smaller, and quicker to decode) msgpack encoding, which needs
+the msgpack package. With TMPSTORE_COMPRESS_MIN set, the values of at least that many bytes
+get compressed with zlib.
+
+Everything but plain JSON starts with a format byte, telling how the rest is encoded; a
+new encoding would get a new format byte. Whatever the TMPSTORE_CODEC, all the formats can
+be read, including the plain JSON written before the switch. To change the codec of a web
+app with several processes, upgrade them all first (with the codec left alone), then set
+TMPSTORE_CODEC, so that no process gets values that it can't read.
+"""
+
+TMPSTORE_CODEC = getattr(constants, 'TMPSTORE_CODEC', 'json')
+TMPSTORE_COMPRESS_MIN = getattr(constants, 'TMPSTORE_COMPRESS_MIN', 0)
+ZLIB_LEVEL = 6
+
+if TMPSTORE_CODEC not in ('json', 'msgpack'):
+    raise ValueError("unknown TMPSTORE_CODEC '{0}'".format(TMPSTORE_CODEC))
+
+# plain JSON text starts with one of {["-tfn or a digit, never with one of these
+JSON_ZLIB = b"\x01"
+MSGPACK = b"\x02"
+MSGPACK_ZLIB = b"\x03"
+FORMATS = (JSON_ZLIB, MSGPACK, MSGPACK_ZLIB)
+
+msgpack = lazy.lazy_import("msgpack")
+
+
+def encode(value):
+    """
+    a value, as a string to save in the temp store
+    """
+    if TMPSTORE_CODEC == 'msgpack':
+        data, plain, compressed = msgpack.packb(value, use_bin_type=True), MSGPACK, MSGPACK_ZLIB
+    else:
+        data, plain, compressed = json.dumps(value), b"", JSON_ZLIB
+    if TMPSTORE_COMPRESS_MIN and len(data) >= TMPSTORE_COMPRESS_MIN:
+        z = zlib.compress(data, ZLIB_LEVEL)
+        if len(z) < len(data):
+            return compressed + z
+    return plain + data
+
+def decode(data):
+    """
+    the value of a string saved with encode(), in any of the formats; None stays None
+    """
+    if data is None:
+        return None
+    f = data[:1]
+    if f == MSGPACK:
+        return msgpack.unpackb(data[1:], raw=False)
+    elif f == MSGPACK_ZLIB:
+        return msgpack.unpackb(zlib.decompress(data[1:]), raw=False)
+    elif f == JSON_ZLIB:
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data)
+
+def as_json(data):
+    """
+    the JSON text of a value saved with encode(), for the functions of the temp store
+        interface that return JSON; plain JSON is returned as it is, without a decoding
+    """
+    if data is None:
+        return None
+    f = data[:1]
+    if f == JSON_ZLIB:
+        return zlib.decompress(data[1:])
+    elif f in FORMATS:
+        return json.dumps(decode(data))
+    return data
@@ -5,10 +5,58 @@ API_SECRET = "YOUR_CIPHERWALLET_API_SECRET"
 
 # API location
 API_URL = "http://api.cqr.io"
+# requests to the API go thru a pool of keep-alive connections: max connections kept open, 
+#    connect and read timeouts (seconds), and how many times a failed PUT is retried (with 
+#    exponential backoff between attempts)
+API_POOL_SIZE = 10
+API_CONNECT_TIMEOUT = 3.05
+API_READ_TIMEOUT = 10
+API_RETRIES = 3
+API_RETRY_BACKOFF = 0.3
+# after API_BREAKER_THRESHOLD consecutive failed API requests, QR code requests are answered with 
+#    a blank image, without calling the API, for the next API_BREAKER_COOLDOWN seconds
+API_BREAKER_THRESHOLD = 5
+API_BREAKER_COOLDOWN = 30
 # preferred hashing method to use on message encryption: md5, sha1, sha256 or sha512
 H_METHOD = "sha256"
-# how long (in seconds) do we delay a "still waiting for user data" poll response
+# a poll that finds no data, and isn't held (see POLL_MAX_HOLD below), is answered after this 
+#    many seconds, for the browsers running an older cipherwallet.js that ignores the Retry-After 
+#    header (see POLL_RETRY_MIN below) and would poll again at once; with a sync web server 
+#    worker, each of these polls holds on to the worker meanwhile. also how soon (in seconds) 
+#    a browser reconnects a broken event stream
 POLL_DELAY = 2
+# with a temp store that can notify about new data (redis), a poll request waiting for user data 
+#    is held for up to this many seconds and answered as soon as the data arrives, instead of 
+#    being answered right away; keep it below the 10 seconds timeout of the AJAX call in cipherwallet.js, 
+#    and run the web server with an async worker (gevent, eventlet) so waiting polls don't each 
+#    hold on to a thread. when not set, it's 8 seconds under gevent or eventlet, and 0 (never 
+#    hold) otherwise
+#POLL_MAX_HOLD = 8
+# browsers that wait for the data on a server-sent events stream (the useEvents option in 
+#    cipherwallet.js) receive a keep-alive message every this many seconds; the streams are 
+#    only served with a temp store that can notify about new data (memory, redis), the 
+#    browsers fall back to polling with the others
+EVENTS_KEEPALIVE = 15
+# "still waiting" poll responses tell the browser how long to pause before the next poll: 
+#    POLL_RETRY_MIN seconds for a fresh QR code, doubling for every POLL_RETRY_STEP seconds 
+#    since it was displayed, up to POLL_RETRY_MAX seconds
+POLL_RETRY_MIN = 1
+POLL_RETRY_STEP = 30
+POLL_RETRY_MAX = 8
+# time the request handlers, temp store operations, API requests and database queries, and 
+#    export the figures in the prometheus format at /cipherwallet/metrics (restrict the access 
+#    to this URL to your monitoring system)
+METRICS_ENABLED = False
+# trace one in every PROFILE_SAMPLE_RATE requests, and every request slower than PROFILE_SLOW_THRESHOLD 
+#    seconds, with a breakdown of where the time went; the latest PROFILE_RING_SIZE traces are kept in 
+#    memory (see profiling.dump(), or send the process the PROFILE_DUMP_SIGNAL), and appended to the  
+#    PROFILE_FILE, if set (rotated when larger than PROFILE_FILE_MAX_BYTES, keeping PROFILE_FILE_BACKUPS)
+#    leave both PROFILE_SAMPLE_RATE and PROFILE_SLOW_THRESHOLD at 0 to turn the tracing off
+PROFILE_SAMPLE_RATE = 0
+PROFILE_SLOW_THRESHOLD = 0
+#PROFILE_RING_SIZE = 1000
+#PROFILE_FILE = "/var/log/cipherwallet/traces.log"; PROFILE_FILE_MAX_BYTES = 10485760; PROFILE_FILE_BACKUPS = 3
+#PROFILE_DUMP_SIGNAL = "SIGUSR2"
 # service id, always "cipherwallet"
 SERVICE_ID = "cipherwallet"
 # an alphabet with characters used to generate random strings
@@ -20,11 +68,40 @@ ALPHABET = "1234567890abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_@"
 #TMP_DATASTORE = 'memcached'; MCD_CONFIG = ['localhost:11211', 'localhost:11212']
 #   redis:
 #TMP_DATASTORE = 'redis'; REDIS_HOST = "localhost"; REDIS_PORT = 6379; REDIS_DB = 0
+#   (optional) spread the keys over several redis servers: REDIS_MODE = 'cluster' finds the cluster from
+#   the REDIS_NODES list, REDIS_MODE = 'sharded' hashes the keys over the REDIS_SHARDS servers
+#REDIS_MODE = 'cluster'; REDIS_NODES = [("redis-1", 6379), ("redis-2", 6379), ("redis-3", 6379)]
+#REDIS_MODE = 'sharded'; REDIS_SHARDS = [("redis-1", 6379, 0), ("redis-2", 6379, 0)]
+#   (optional) read replicas for the polls: [(host, port), ...] for a single server, 
+#   {shard index: [(host, port), ...]} when sharded, or True for a cluster
+#REDIS_REPLICAS = [("redis-replica", 6379)]
+#   (optional) at most how many connections to each server, and how long to wait for one
+#REDIS_POOL_SIZE = 50; REDIS_POOL_TIMEOUT = 5
 #   plaintext files:
 #TMP_DATASTORE = 'sessionfiles'; TMPSTORE_DIR = "/path/to/session/directory/"
+#   (the plaintext files store cleans up one of its 256 subdirectories every TMPSTORE_SWEEP_INTERVAL seconds)
+#TMPSTORE_SWEEP_INTERVAL = 10
+#   memory of the web app process (single process web apps and tests only):
+#TMP_DATASTORE = 'memory'
+#   (the memory store is split in MEMSTORE_SHARDS dictionaries, each with its own lock, so that the 
+#   threads of the process seldom wait for each other; more shards for more threads)
+#MEMSTORE_SHARDS = 64
+#   memory-mapped file, shared by all the web app processes on this host (file size is slots * slot size):
+#TMP_DATASTORE = 'mmap'; MMAP_PATH = "/dev/shm/cipherwallet.tmpstore"; MMAP_SLOTS = 16384; MMAP_SLOT_SIZE = 8192
+#   (a value, like the data posted by the mobile app for a signup form, can take up to MMAP_SLOT_SIZE - 146 
+#   bytes; bigger ones are refused, and the callback fails. processes with different slot settings 
+#   can't share a file: change MMAP_PATH too when changing them)
+# (optional, all but the memory store) save the temp store values in the msgpack format (smaller, quicker 
+#    to decode; needs the msgpack package) instead of JSON, and compress the values of at least 
+#    TMPSTORE_COMPRESS_MIN bytes; read codec.py before changing these on a web app that is running
+#TMPSTORE_CODEC = 'msgpack'; TMPSTORE_COMPRESS_MIN = 1024
 # how long are we supposed to retain the information about a QR scanning session
 # the value should be slightly larger than the maximum QR time-to-live that you use
 CW_SESSION_TIMEOUT = 610
+# nonces are also remembered in each process, to catch replays without asking the temporary 
+#    datastore: how many nonces at most, grouped in buckets of how many seconds
+NONCE_CACHE_SIZE = 100000
+NONCE_CACHE_BUCKET = 60
 
 # for logins via QR code scanning, you need to provide access to a SQL database where your users 
 #     information is stored (we're assuming here you are using a SQL database). cipherwallet only 
@@ -39,13 +116,20 @@ CW_SESSION_TIMEOUT = 610
 #DB_CONNECTION_STRING = "sqlite:////path/to/your/dbfile.db"
 DB_CONNECTION_USERNAME = "god"
 DB_CONNECTION_PASSWORD = "zzyzx"
+# database connections are taken from a pool: connections kept open, extra connections allowed 
+#    under load, seconds to wait for a free connection, and max age (seconds) of a connection
+#    (the pool size settings are ignored for sqlite)
+DB_POOL_SIZE = 5
+DB_POOL_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
 
 # in your database, YOU MUST create a table called 'cw_logins', which will have a 1-1 relationship with
 #    your users table; something like this (but check the correct syntax for on your SQL server type):
 """ 
 CREATE TABLE cw_logins (
     user_id VARCHAR(...) PRIMARY KEY,  -- or whatever type your unique user ID is
-    cw_id VARCHAR(20),
+    cw_id VARCHAR(20) UNIQUE,
     secret VARCHAR(128),
     reg_tag CHAR(),                    -- it's an UUID
     hash_method VARCHAR(8),            -- can be md5, sha1, sha256
@@ -64,7 +148,12 @@ CREATE TABLE cw_logins (
 #    can be md5, sha1, sha256
 # 'created' is the date when the record was created, epoch format (feel free to change this field type 
 #    to a date/time field, if you find it more convenient)
-# you should also create an index on cw_id, it will help during your queries
+# cw_id MUST be unique and indexed, QR logins look up the users by it (the UNIQUE constraint above 
+#    creates the index); if your table was created without it, apply the migration in 
+#    migrations/001_cw_logins_unique_cw_id.sql
+# user_id MUST be the primary key (or at least unique): the user's credentials are replaced with 
+#    a single INSERT ... ON CONFLICT / ON DUPLICATE KEY UPDATE statement on sqlite, postgresql and 
+#    mysql
 
 # your user's secret keys must be stored in an encrypted form in the cw_logins table
 # we use an AES-256 encryption algorithm for that, with the encryption key below
@@ -74,11 +163,24 @@ CREATE TABLE cw_logins (
 # hint: to easily generate a 32-byte encryption key like needed here, just generate 2 random UUIDs, 
 #    concatenate them, and remove the formatting dashes
 
+# decrypted login credentials are cached in each process, for faster QR logins: how many users 
+#    at most, and for how long (seconds). a credentials change or removal made by one process is 
+#    seen by the other processes only when their cached copy expires, so keep the ttl short
+LOGIN_CACHE_SIZE = 10000
+LOGIN_CACHE_TTL = 60
+
 OP_SIGNUP = "signup"
 OP_LOGIN = "login"
 OP_CHECKOUT = "checkout"
 OP_REGISTRATION = "reg"
 
+# QR codes pre-generation (see 'pool_depth' below): how often (seconds) the pool gets refilled, 
+#    how many QR codes per tag get requested from the API on each refill, and how many seconds 
+#    must a pooled QR code still have to live in order to be handed out
+QR_POOL_REFILL_INTERVAL = 1
+QR_POOL_REFILL_BATCH = 5
+QR_POOL_MIN_TTL = 20
+
 # provide a service descriptor entry in this map for every cipherwallet QR code you are using
 # on each entry, you provide:
 #    - 'operation': the operation type, one of the OP_* constants above 
@@ -91,6 +193,10 @@ OP_REGISTRATION = "reg"
 #    - 'confirmation': a message to be displayed as a popup-box in the mobile app, that informs if 
 #          the last QR code scanning and data transfer operations was successful or not; you may  
 #          provide a string, or a function that returns a string
+#    - 'pool_depth': how many QR codes to prepare ahead of time, so that the page gets its QR code 
+#          without waiting for the cipherwallet API; every pooled QR code is an API request, even 
+#          if it never gets displayed. not available for registration services, or when 'display' 
+#          is a function
 # the service descriptor parameters specified here will override the ones pre-programmed with the 
 #    the dashboard page
 # the 'operation' must be specified; 'qr_ttl' has default and max values for each type of service; 
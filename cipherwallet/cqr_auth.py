@@ -11,9 +11,43 @@ from db_interface import (
     get_key_and_id_for_qr_login
 )
 from constants import API_SECRET
+import profiling
 
 # common functions used by the QRAccess SDK
 
+HASH_METHODS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "sha512": hashlib.sha512,
+}
+
+# keyed HMAC objects that didn't hash anything yet, by (secret key, hash method)
+keyed_hmacs = {}
+
+def keyed_hmac(secret_key, hash_method):
+    """
+    return a new HMAC object for a secret key and a hash method, ready to be fed with 
+        the signature; the key padding and the inner / outer hash states are computed 
+        only once for our own API secret, and then copied for every request
+    """
+    try:
+        return keyed_hmacs[(secret_key, hash_method)].copy()
+    except KeyError:
+        h = hmac.new(secret_key, digestmod=HASH_METHODS[hash_method])
+        if secret_key == API_SECRET:
+            keyed_hmacs[(secret_key, hash_method)] = h.copy()
+        return h
+
+def signed(secret_key, hash_method, signature):
+    """
+    the base64-encoded HMAC of a signature string
+    """
+    h = keyed_hmac(secret_key, hash_method)
+    h.update(signature)
+    return base64.b64encode(h.digest())
+
+
 def auth(customer_id, secret_key, http_method, resource, params={}, hash_method="sha1"):
     """
     create and return a set of custom headers to go in a cqr-authorized API request, 
@@ -28,32 +62,22 @@ def auth(customer_id, secret_key, http_method, resource, params={}, hash_method=
     auth_headers['X-Hash-Method'] = hash_method
 
     # prepare signature - headers and sorted parameters
-    signature = http_method.upper() + " " + resource.lower() + "\n"
-    for k, v in auth_headers.items():
-        signature = signature + k + ":" + v + "\n"
+    signature = "\n".join(
+        [ http_method.upper() + " " + resource.lower() ] + 
+        [ k + ":" + v for k, v in auth_headers.items() ]
+    ) + "\n"
     if type(params) == type({}):
-        for k in sorted(params.iterkeys()):
-            signature = signature + k + "=" + str(params[k]) + "\n"
-        if len(params):
-            signature = signature[:-1]
+        signature += "\n".join(k + "=" + str(params[k]) for k in sorted(params.iterkeys()))
     elif type(params) == type(""):
-        signature = signature + params
+        signature += params
 
 	# hash with client secret key and base64-encode
-    h = ""
-    if hash_method == "md5":
-        h = hmac.new(secret_key, signature, hashlib.md5)
-    elif hash_method == "sha1":
-        h = hmac.new(secret_key, signature, hashlib.sha1)
-    elif hash_method == "sha256":
-        h = hmac.new(secret_key, signature, hashlib.sha256)
-    elif hash_method == "sha512":
-        h = hmac.new(secret_key, signature, hashlib.sha512)
-    auth_headers['Authorization'] = "CQR 1.0 " + base64.b64encode(h.digest())
+    auth_headers['Authorization'] = "CQR 1.0 " + signed(secret_key, hash_method, signature)
 
     # return the array of headers
     return auth_headers
 
+@profiling.spanned("cqr.verify")
 def verify(http_method, uri, headers, params, authorization):
     """
     we verify a set of parameters against a given authorization string; return a boolean
@@ -66,21 +90,22 @@ def verify(http_method, uri, headers, params, authorization):
     received_crypto_sig = auth_parts[2]
     
     # recompose signature with method, url...
-    signature = http_method.upper() + " " + uri.lower() + "\n"
+    signature = [ http_method.upper() + " " + uri.lower() ]
     # ... auth headers...
     auth_headers = ['X-Client-Id', 'X-Timestamp', 'X-Nonce', 'X-Hash-Method']
     for header in auth_headers:
         value = headers.get(header)
         if value is None:
             return False
-        signature = signature + header + ":" + value + "\n"
+        signature.append(header + ":" + value)
+    signature = "\n".join(signature) + "\n"
     # ... and request params (if any)
     if type(params) == type({}) and len(params) > 0:
-        for k in sorted(params.iterkeys()):
-            signature = signature + k + "=" + str(params[k]) + "\n"
-        signature = signature[:-1]
+        signature += "\n".join(k + "=" + str(params[k]) for k in sorted(params.iterkeys()))
     elif type(params) == type(""):
-        signature = signature + params
+        signature += params
+    if headers['X-Hash-Method'] not in HASH_METHODS:
+        return False
     
     # verify timestamp drift
     if not verify_timestamp(int(headers['X-Timestamp'])):
@@ -90,18 +115,9 @@ def verify(http_method, uri, headers, params, authorization):
         return False
     
     # build encrypted signature
-    h = ""
-    if headers['X-Hash-Method'] == "md5":
-        h = hmac.new(API_SECRET, signature, hashlib.md5)
-    elif headers['X-Hash-Method'] == "sha1":
-        h = hmac.new(API_SECRET, signature, hashlib.sha1)
-    elif headers['X-Hash-Method'] == "sha256":
-        h = hmac.new(API_SECRET, signature, hashlib.sha256)
-    elif headers['X-Hash-Method'] == "sha512":
-        h = hmac.new(API_SECRET, signature, hashlib.sha512)
-
-    return base64.b64encode(h.digest()) == received_crypto_sig
+    return signed(API_SECRET, headers['X-Hash-Method'], signature) == received_crypto_sig
 
+@profiling.spanned("cqr.authorize")
 def authorize(auth_data):
     # A mobile user sent us, via the API server, an array of parameters:
     #    user= their user id
@@ -133,24 +149,11 @@ def authorize(auth_data):
     h_sig_received = authorization.replace(".", "+")
     del auth_data['authorization']
     # order the user's auth params list and build the signature string
-    signature = ""
-    for k in sorted(auth_data.iterkeys()):
-        signature = signature + k + "=" + str(auth_data[k]) + "\n"
-    signature = signature[:-1]
+    signature = "\n".join(k + "=" + str(auth_data[k]) for k in sorted(auth_data.iterkeys()))
     
     # get user's secret key and hash the signature with it
     uid, uk, umeth = get_key_and_id_for_qr_login(user)
     if uid is None or umeth != h_meth:
         return None
-    h = ""
-    if h_meth == "md5":
-        h = hmac.new(uk, signature, hashlib.md5)
-    elif h_meth == "sha1":
-        h = hmac.new(uk, signature, hashlib.sha1)
-    elif h_meth == "sha256":
-        h = hmac.new(uk, signature, hashlib.sha256)
-    elif h_meth == "sha512":
-        h = hmac.new(uk, signature, hashlib.sha512)
-
-    return uid if base64.b64encode(h.digest()) == h_sig_received else None
 
+    return uid if signed(uk, h_meth, signature) == h_sig_received else None
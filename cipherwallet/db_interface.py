@@ -3,29 +3,127 @@ import base64
 import uuid
 import time
 import random
-import importlib
-import sqlalchemy
-from sqlalchemy.sql import text as sql_statement
-from Crypto import Random, Cipher
+import itertools
+import contextlib
 
 from constants import *
+import constants
+import caches
+import lazy
+import metrics
+import profiling
+import tmpstore
 
 AES_BLOCKSIZE = 16
 
+# the database and crypto libraries get imported when first used
+sqlalchemy = lazy.lazy_import("sqlalchemy")
+Random = lazy.lazy_import("Crypto.Random")
+AES = lazy.lazy_import("Crypto.Cipher.AES")
+
+def sql_statement(statement):
+    return sqlalchemy.sql.text(statement)
+
 ## a basic set of functions interacting with your users database
 ## we use PDO to connect to your database; DSN, username and password reside in the
 ##    cipherwallet-constants.lib.php module
 
-try:
-    db_engine = sqlalchemy.create_engine(
-        DB_CONNECTION_STRING.format(DB_CONNECTION_USERNAME, DB_CONNECTION_PASSWORD)
+# connection pool settings: connections kept open, extra connections allowed under load, 
+#    how long (seconds) to wait for a free connection, and how old (seconds) can a 
+#    connection get before it's replaced
+DB_POOL_SIZE = getattr(constants, 'DB_POOL_SIZE', 5)
+DB_POOL_MAX_OVERFLOW = getattr(constants, 'DB_POOL_MAX_OVERFLOW', 10)
+DB_POOL_TIMEOUT = getattr(constants, 'DB_POOL_TIMEOUT', 30)
+DB_POOL_RECYCLE = getattr(constants, 'DB_POOL_RECYCLE', 1800)
+
+# a database may not be needed after all, so the engine is only created on first use
+db_engine = None
+db_lock = lazy.Lock()
+db_pool_counters = { 'checkouts': 0, 'connects': 0, 'wait_time': 0.0, 'max_wait': 0.0 }
+
+def _engine():
+    global db_engine
+    if db_engine is None:
+        with db_lock:
+            if db_engine is None:
+                options = { 'pool_pre_ping': True, 'pool_recycle': DB_POOL_RECYCLE }
+                if not DB_CONNECTION_STRING.startswith("sqlite"):
+                    # sqlite engines come with their own (single connection) pool types
+                    options.update(
+                        pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW, 
+                        pool_timeout=DB_POOL_TIMEOUT
+                    )
+                engine = sqlalchemy.create_engine(
+                    DB_CONNECTION_STRING.format(DB_CONNECTION_USERNAME, DB_CONNECTION_PASSWORD), 
+                    **options
+                )
+                sqlalchemy.event.listen(engine, "connect", _connected)
+                sqlalchemy.event.listen(engine, "checkout", _checked_out)
+                if metrics.METRICS_ENABLED:
+                    sqlalchemy.event.listen(engine, "before_cursor_execute", _query_started)
+                    sqlalchemy.event.listen(engine, "after_cursor_execute", _query_ended)
+                db_engine = engine
+    return db_engine
+
+def _connected(dbapi_connection, connection_record):
+    connection_record.info['pid'] = lazy.pid()
+    with db_lock:
+        db_pool_counters['connects'] += 1
+
+def _checked_out(dbapi_connection, connection_record, connection_proxy):
+    # a pooled connection opened before a fork belongs to the parent process: the pool drops 
+    #    it, without closing it (that would close it for the parent too), and opens a new one
+    if connection_record.info.get('pid') != lazy.pid():
+        connection_record.connection = connection_proxy.connection = None
+        raise sqlalchemy.exc.DisconnectionError("connection inherited from the parent process")
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    context._cw_query_started = time.time()
+
+def _query_ended(conn, cursor, statement, parameters, context, executemany):
+    # labelled with the statement type: SELECT, INSERT, DELETE...
+    metrics.observe(
+        "db_query", time.time() - context._cw_query_started, statement=statement.split(None, 1)[0].upper()
     )
-    db = db_engine.connect()
-except:
-    # a database may not be needed after all, so dont trigger an exception here, 
-    #    leave it up to the service to handle
-    pass
-    
+
+@contextlib.contextmanager
+def connection():
+    """
+    check out a database connection from the pool, for the duration of a with block
+    stale connections (e.g. after a database restart) are detected and replaced on checkout
+    """
+    t0 = time.time()
+    db = _engine().connect()
+    waited = time.time() - t0
+    with db_lock:
+        db_pool_counters['checkouts'] += 1
+        db_pool_counters['wait_time'] += waited
+        db_pool_counters['max_wait'] = max(db_pool_counters['max_wait'], waited)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def warmup(database=True):
+    """
+    import the crypto modules and, with database, create the engine (without connecting)
+    """
+    AES()
+    Random()
+    if database:
+        _engine()
+
+def db_pool_stats():
+    """
+    connection checkouts, new connections opened, and time spent waiting for a connection
+    """
+    with db_lock:
+        stats = dict(db_pool_counters)
+    pool = db_engine.pool if db_engine is not None else None
+    stats['checked_out'] = pool.checkedout() if hasattr(pool, 'checkedout') else 0
+    stats['pool_size'] = pool.size() if hasattr(pool, 'size') else 0
+    return stats
+
 
 ###############################################################################
 
@@ -37,6 +135,26 @@ def verify_timestamp(ts):
     now = int(time.time())
     return (ts >= (now - 3600)) and (ts <= (now + 3600))
 
+# nonces are remembered for an hour
+NONCE_TTL = 3600
+# nonces seen by this process are remembered locally too, so that an obvious replay gets 
+#    rejected without a trip to the temp store; the temp store remains the authority
+local_nonces = caches.ExpiringSet(
+    getattr(constants, 'NONCE_CACHE_BUCKET', 60), getattr(constants, 'NONCE_CACHE_SIZE', 100000)
+)
+tmp_datastore = None
+
+# decrypted login credentials (user id, secret key, hash method) by cipherwallet user id, 
+#    so that a QR login doesn't need a database query and a decryption every time
+# the cache is per process: a credentials change made by another process becomes visible 
+#    here only after LOGIN_CACHE_TTL seconds, so keep that short
+qr_logins = caches.LRUCache(
+    getattr(constants, 'LOGIN_CACHE_SIZE', 10000), getattr(constants, 'LOGIN_CACHE_TTL', 60)
+)
+# the AES key for the user's secrets, in binary form
+secret_enc_key = None
+
+@profiling.spanned("db.verify_nonce")
 def verify_nonce(user, nonce):
     """
     used by the authorization verification function
@@ -44,8 +162,25 @@ def verify_nonce(user, nonce):
         in the last few minutes / hours
     typically we defer this function to the temporary key-value store layer
     """
-    tmp_datastore = importlib.import_module("cipherwallet.tmpstore_{0}".format(TMP_DATASTORE))
-    return tmp_datastore.is_nonce_valid(user, nonce, 3600)
+    global tmp_datastore
+    key = "{0}_{1}".format(user, nonce)
+    if key in local_nonces:
+        return False
+    if tmp_datastore is None:
+        # the temp store modules import this one, so we can only load it on first use
+        tmp_datastore = tmpstore.load()
+    # remembered only once the temp store took it: a nonce that didn't make it there (the
+    #    store failed, or was unreachable) may be retried
+    if not tmp_datastore.is_nonce_valid(user, nonce, NONCE_TTL):
+        return False
+    local_nonces.add(key, NONCE_TTL)
+    return True
+
+def nonce_cache_stats():
+    """
+    hit rate (i.e. replays caught locally) and memory footprint of the local nonce cache
+    """
+    return local_nonces.stats()
 
 def accepted_hash_method(h):
     """
@@ -55,6 +190,18 @@ def accepted_hash_method(h):
         return "sha1"
     return h if h in ["md5", "sha1", "sha256", "sha512"] else ""
 
+def _secret_enc_key():
+    global secret_enc_key
+    if secret_enc_key is None:
+        secret_enc_key = CW_SECRET_ENC_KEY.decode("hex")
+    return secret_enc_key
+
+def _secret_bytes(plaintext):
+    # secrets that went thru json (like the ones kept in the temp store) come back as unicode
+    if isinstance(plaintext, unicode):
+        return plaintext.encode("utf-8")
+    return plaintext
+
 def encrypt_secret(plaintext):
     """
     use this function to encrypt user's secret key used in the signup / registration service
@@ -62,8 +209,21 @@ def encrypt_secret(plaintext):
     """
     # passphrase MUST be 16, 24 or 32 bytes long, how can I do that ?
     iv = Random.new().read(AES_BLOCKSIZE)
-    aes = Cipher.AES.new(CW_SECRET_ENC_KEY.decode("hex"), Cipher.AES.MODE_CFB, iv)
-    return base64.b64encode(iv + aes.encrypt(plaintext))    
+    aes = AES.new(_secret_enc_key(), AES.MODE_CFB, iv)
+    return base64.b64encode(iv + aes.encrypt(_secret_bytes(plaintext)))    
+
+def encrypt_secrets(plaintexts):
+    """
+    encrypt_secret() for a list of secret keys, sharing the random source and the 
+        encryption key setup; each secret still gets its own IV
+    """
+    rnd = Random.new()
+    key = _secret_enc_key()
+    encrypted = []
+    for plaintext in plaintexts:
+        iv = rnd.read(AES_BLOCKSIZE)
+        encrypted.append(base64.b64encode(iv + AES.new(key, AES.MODE_CFB, iv).encrypt(_secret_bytes(plaintext))))
+    return encrypted
 
 def decrypt_secret(encrypted_text):
     """
@@ -72,7 +232,7 @@ def decrypt_secret(encrypted_text):
     """
     encrypted_bytes = base64.b64decode(encrypted_text)
     iv = encrypted_bytes[:AES_BLOCKSIZE]
-    aes = Cipher.AES.new(CW_SECRET_ENC_KEY.decode("hex"), Cipher.AES.MODE_CFB, iv)
+    aes = AES.new(_secret_enc_key(), AES.MODE_CFB, iv)
     return aes.decrypt(encrypted_bytes[AES_BLOCKSIZE:])
 
 def create_cipherwallet_user(reg):
@@ -89,6 +249,59 @@ def create_cipherwallet_user(reg):
 
 ###############################################################################
 
+INSERT_LOGIN = (
+    "INSERT INTO cw_logins(user_id, cw_id, secret, reg_tag, hash_method, created) " +
+    "VALUES (:user_id, :cw_id, :secret, :reg_tag, :hash_meth, :now)"
+)
+# replacing a user's credentials is a single statement, on the databases that support it
+UPSERT_LOGIN = {
+    'sqlite': INSERT_LOGIN + " ON CONFLICT (user_id) DO UPDATE SET " + 
+        "cw_id = excluded.cw_id, secret = excluded.secret, reg_tag = excluded.reg_tag, " +
+        "hash_method = excluded.hash_method, created = excluded.created;",
+    'mysql': INSERT_LOGIN + " ON DUPLICATE KEY UPDATE " + 
+        "cw_id = VALUES(cw_id), secret = VALUES(secret), reg_tag = VALUES(reg_tag), " +
+        "hash_method = VALUES(hash_method), created = VALUES(created);",
+}
+UPSERT_LOGIN['postgresql'] = UPSERT_LOGIN['sqlite']
+# ... and since which server version
+UPSERT_LOGIN_SINCE = { 'sqlite': (3, 24, 0), 'postgresql': (9, 5) }
+
+def _upsert_login(dialect):
+    since = UPSERT_LOGIN_SINCE.get(dialect.name)
+    if since is not None and tuple(dialect.server_version_info or ()) < since:
+        return None
+    return UPSERT_LOGIN.get(dialect.name)
+
+def _save_logins(db, logins):
+    """
+    insert or replace cw_logins records, in a transaction; returns the affected rows count
+    the databases (or database versions) without an upsert statement get a DELETE and an 
+        INSERT instead, in the same transaction
+    """
+    with db.begin():
+        upsert = _upsert_login(db.dialect)
+        if upsert is not None:
+            return db.execute(sql_statement(upsert), logins).rowcount
+        db.execute(
+            sql_statement("DELETE FROM cw_logins WHERE user_id IN :user_ids;").bindparams(
+                sqlalchemy.bindparam('user_ids', expanding=True)
+            ),
+            user_ids=[ login['user_id'] for login in logins ]
+        )
+        return db.execute(sql_statement(INSERT_LOGIN + ";"), logins).rowcount
+
+def _login_group(user_id):
+    # the cached credentials are grouped by user id, as text: the database may return a number
+    #    where the callers pass the id as they got it from a web form
+    if isinstance(user_id, bytes):
+        return user_id.decode("utf-8", "replace")
+    return unicode(user_id)
+
+def _forget_logins(user_ids):
+    for user_id in user_ids:
+        qr_logins.discard_group(_login_group(user_id))
+
+@profiling.spanned("db.set_user_data_for_qr_login")
 def set_user_data_for_qr_login(user_id, extra_data):
     """
     add cipherwallet-specific login credentials to the user record
@@ -96,52 +309,67 @@ def set_user_data_for_qr_login(user_id, extra_data):
     """
     # the cipherwallet usernames we generate are hex strings
     # the user ID is submitted by your app, so we assume it's safe already
+    _forget_logins([ user_id ])
     try:
-        db.execute(
-            sql_statement("DELETE FROM cw_logins WHERE user_id = :user_id;"),
-            user_id=user_id
-        )
-        rp = db.execute(
-            sql_statement(
-                "INSERT INTO cw_logins(user_id, cw_id, secret, reg_tag, hash_method, created) " +
-                "VALUES (:user_id, :cw_id, :secret, :reg_tag, :hash_meth, :now);"
-            ),
-            user_id=user_id,
-            cw_id=extra_data['cw_user'],
-            secret=encrypt_secret(extra_data['secret']),
-            reg_tag=extra_data['registration'],
-            hash_meth=H_METHOD,
-            now=time.time()
-        )
-        if rp.rowcount:
-            return {
+        with connection() as db:
+            rowcount = _save_logins(db, [{
                 'user_id': user_id,
                 'cw_id': extra_data['cw_user'],
-                'secret': extra_data['secret'],
+                'secret': encrypt_secret(extra_data['secret']),
                 'reg_tag': extra_data['registration'],
-                'now': int(time.time()),
-            }
-        else:
-            return None
+                'hash_meth': H_METHOD,
+                'now': time.time(),
+            }])
+            if rowcount:
+                return {
+                    'user_id': user_id,
+                    'cw_id': extra_data['cw_user'],
+                    'secret': extra_data['secret'],
+                    'reg_tag': extra_data['registration'],
+                    'now': int(time.time()),
+                }
+            else:
+                return None
     except Exception as e:
         return None    
+    finally:
+        # once more after the commit: a concurrent login may have read the old credentials 
+        #    before the commit, and cached them since; the ones that are still to cache them 
+        #    won't, see get_key_and_id_for_qr_login()
+        _forget_logins([ user_id ])
 
 
+@profiling.spanned("db.get_key_and_id_for_qr_login")
 def get_key_and_id_for_qr_login(cw_user):
     """
     get an user's secret key from the database, in order to authenticate them
     the secret key has been associated with the user by user_data_for_qr_login() 
     """
+    login = qr_logins.get(cw_user)
+    if login is not None:
+        return login
+    # credentials changed (and forgotten) while we read them don't get cached
+    since = qr_logins.generation()
     try:
-        rs = db.execute(
-            sql_statement(
-                "SELECT user_id, secret, hash_method FROM cw_logins WHERE cw_id = :cw_id;"
-            ),
-            cw_id=cw_user
-        ).fetchone()
-        return (rs[0], decrypt_secret(rs[1]), rs[2])
+        with connection() as db:
+            rs = db.execute(
+                sql_statement(
+                    "SELECT user_id, secret, hash_method FROM cw_logins WHERE cw_id = :cw_id;"
+                ),
+                cw_id=cw_user
+            ).fetchone()
+            login = (rs[0], decrypt_secret(rs[1]), rs[2])
     except Exception as e:
         return (None, None, None)
+    qr_logins.set(cw_user, login, group=_login_group(login[0]), since=since)
+    return login
+
+
+def login_cache_stats():
+    """
+    hit / miss counters of the login credentials cache
+    """
+    return qr_logins.stats()
 
 
 def get_user_for_qr_login(user_id):
@@ -149,11 +377,12 @@ def get_user_for_qr_login(user_id):
     get an user's cipherwallet id, based on the database normal user ID
     """
     try:
-        rs = db.execute(
-            sql_statement("SELECT cw_id FROM cw_logins WHERE user_id = :user_id;"),
-            user_id=user_id
-        ).fetchone()
-        return rs[0]
+        with connection() as db:
+            rs = db.execute(
+                sql_statement("SELECT cw_id FROM cw_logins WHERE user_id = :user_id;"),
+                user_id=user_id
+            ).fetchone()
+            return rs[0]
     except Exception:
         return None
     
@@ -164,11 +393,75 @@ def remove_user_for_qr_login(user_id):
     the cw_logins table
     invoke with the real user ID as a parameter
     """
+    _forget_logins([ user_id ])
     try:
-        return db.execute(
-            "DELETE FROM cw_logins WHERE user_id = :user_id;", 
-            user_id=user_id
-        ).rowcount == 1;
+        with connection() as db:
+            return db.execute(
+                "DELETE FROM cw_logins WHERE user_id = :user_id;", 
+                user_id=user_id
+            ).rowcount == 1;
     except Exception:
         return False
+    finally:
+        _forget_logins([ user_id ])
+
+
+def _chunks(iterable, chunk_size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def set_user_data_for_qr_login_bulk(records, chunk_size=1000):
+    """
+    set_user_data_for_qr_login() for many users: records is an iterable (it may be a 
+        generator) of (user_id, extra_data) pairs
+    each chunk of records is written in its own transaction, with a batched (executemany) 
+        upsert; returns the number of records saved
+    extra_data may also indicate the 'hash_method' of the credentials (it defaults to H_METHOD)
+    """
+    saved = 0
+    with connection() as db:
+        for chunk in _chunks(records, chunk_size):
+            _forget_logins(user_id for user_id, _ in chunk)
+            now = time.time()
+            secrets = encrypt_secrets([ extra_data['secret'] for _, extra_data in chunk ])
+            _save_logins(db, [
+                {
+                    'user_id': user_id,
+                    'cw_id': extra_data['cw_user'],
+                    'secret': secret,
+                    'reg_tag': extra_data['registration'],
+                    'hash_meth': extra_data.get('hash_method', H_METHOD),
+                    'now': now,
+                } 
+                for (user_id, extra_data), secret in zip(chunk, secrets)
+            ])
+            _forget_logins(user_id for user_id, _ in chunk)
+            saved += len(chunk)
+    return saved
+
+
+def remove_users_for_qr_login_bulk(user_ids, chunk_size=1000):
+    """
+    remove_user_for_qr_login() for many users: user_ids is an iterable (it may be a 
+        generator) of real user IDs
+    each chunk is deleted in its own transaction; returns the number of records removed
+    """
+    removed = 0
+    with connection() as db:
+        for chunk in _chunks(user_ids, chunk_size):
+            _forget_logins(chunk)
+            with db.begin():
+                removed += db.execute(
+                    sql_statement("DELETE FROM cw_logins WHERE user_id IN :user_ids;").bindparams(
+                        sqlalchemy.bindparam('user_ids', expanding=True)
+                    ),
+                    user_ids=chunk
+                ).rowcount
+            _forget_logins(chunk)
+    return removed
 
@@ -1,7 +1,3 @@
-import sqlalchemy
-from sqlalchemy.sql import text as sql_statement
-
-
 # you will need to implement this when you use the registration page
 def get_user_id_for_current_session():
     """
@@ -23,6 +19,9 @@ def authorize_session_for_user(user_id):
        a dictionary with whatever you need to forward to the browser, in response to
        the AJAX poll
     """
+    # imported here rather than at the top, so that importing hooks stays cheap
+    import sqlalchemy
+    from sqlalchemy.sql import text as sql_statement
     try:
         db_engine = sqlalchemy.create_engine('sqlite:///your.db', echo=True)
         db = db_engine.connect()
@@ -0,0 +1,149 @@
+import os
+import importlib
+import threading
+
+####  deferred creation of the expensive things: heavy modules, connection pools, clients  ####
+"""
+The SDK modules don't import their heavy dependencies (sqlalchemy, requests, the crypto and
+the temp store client libraries), and don't create connection pools or clients, when they
+get imported; a LazyResource stands in for each of them, and creates it on first use. A
+worker that only ever serves the callbacks never pays for the database layer, and a short
+lived (serverless) process only pays for what its requests touch.
+
+A pre-fork server parent can call cipherwallet_lib.warmup() to pay for all of it up front,
+before forking the workers. The objects are never shared with a forked child: a child that
+uses a LazyResource gets its own object, created by the factory in that process, so each
+worker has its own connection pools (the parent's ones are left alone, see below).
+The locks that guard the module level state (caches, counters, the in-memory temp store)
+are lazy.Lock()s for the same reason: a child gets new ones, rather than the parent's,
+which may have been held by a thread that didn't survive the fork.
+"""
+
+if hasattr(os, 'register_at_fork'):
+    # python 3.7 and later tell us about the forks, no need for a system call every time
+    _pid = [ os.getpid() ]
+    os.register_at_fork(after_in_child=lambda: _pid.__setitem__(0, os.getpid()))
+    def pid():
+        return _pid[0]
+else:
+    pid = os.getpid
+
+# the objects created by a parent process, in the forked child; they are kept referenced 
+#    so that they dont get garbage collected, because closing a client in the child may 
+#    close (or send a goodbye on) the connections of the parent too
+inherited = []
+
+
+class LazyResource(object):
+    """
+    stands in for an object created by factory() the first time it is needed: call the
+        LazyResource to get the object, or just use its attributes, that are looked up
+        on the object
+    after a fork, the child process gets a new object, on first use
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._resource = None
+        self._lock = threading.Lock()
+        self._pid = pid()
+
+    def __call__(self):
+        resource = self._resource
+        if resource is None or self._pid != pid():
+            if self._pid != pid():
+                # the first of the child's threads to get here drops the parent's object
+                with _fork_lock:
+                    if self._pid != pid():
+                        self._forked()
+            with self._lock:
+                if self._resource is None:
+                    self._resource = self._factory()
+                resource = self._resource
+        return resource
+
+    def __getattr__(self, attr):
+        return getattr(self(), attr)
+
+    def _forked(self):
+        # the lock too may have been held by one of the parent's threads at the time of the fork
+        if self._resource is not None:
+            inherited.append(self._resource)
+        self._resource = None
+        self._lock = threading.Lock()
+        self._pid = pid()
+
+    def created(self):
+        """
+        whether the object exists already, in this process
+        """
+        return self._resource is not None and self._pid == pid()
+
+
+class Lock(object):
+    """
+    a threading.Lock for the module level state, that a forked child process replaces with 
+        a new one on first use: one of the parent's threads may have been holding it at the
+        time of the fork, and that thread doesn't exist in the child to release it
+    forked(), if given, gets called in the child (holding the new lock) before anybody else
+        uses it, to drop what the parent's threads left behind
+    """
+
+    def __init__(self, forked=None):
+        self._forked_callback = forked
+        self._locks = { pid(): threading.Lock() }
+
+    def _lock(self):
+        lock = self._locks.get(pid())
+        if lock is None:
+            lock = self._renew()
+        return lock
+
+    def _renew(self):
+        # setdefault() is atomic, so the threads of the child all end up with the same lock
+        p = pid()
+        new = threading.Lock()
+        new.acquire()
+        try:
+            lock = self._locks.setdefault(p, new)
+            if lock is new:
+                for other in [ k for k in self._locks.keys() if k != p ]:
+                    self._locks.pop(other, None)
+                if self._forked_callback is not None:
+                    self._forked_callback()
+        finally:
+            new.release()
+        return lock
+
+    def acquire(self, blocking=True):
+        return self._lock().acquire(blocking)
+
+    def release(self):
+        self._lock().release()
+
+    def locked(self):
+        return self._lock().locked()
+
+    # the same as acquire() and release(), with fewer calls: these are on the hot paths; only
+    #    the thread holding the lock sets (and uses) _held
+    def __enter__(self):
+        lock = self._locks.get(pid())
+        if lock is None:
+            lock = self._renew()
+        lock.acquire()
+        self._held = lock
+        return True
+
+    def __exit__(self, *exc):
+        self._held.release()
+
+# taken by the threads of a forked child that find a LazyResource of the parent; a lazy.Lock
+#    itself, since a child may fork again
+_fork_lock = Lock()
+
+
+def lazy_import(name):
+    """
+    a module, imported when one of its attributes is first used
+    """
+    return LazyResource(lambda: importlib.import_module(name))
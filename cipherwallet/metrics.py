@@ -0,0 +1,145 @@
+import time
+import functools
+
+import constants
+import lazy
+
+####  counters and timers for the SDK hot paths, exported in the prometheus text format  ####
+"""
+With METRICS_ENABLED set, the SDK times the api_router handlers, the temp store operations,
+the cipherwallet API requests and the database queries, and counts the responses and the
+errors. GET /cipherwallet/metrics returns everything in the prometheus text format, together
+with the gauges reported by the registered collectors (connection pools, caches). When it
+is not set, nothing gets wrapped, so there is no overhead at all.
+
+To send the timings somewhere else too (statsd, logs), register a function with add_hook();
+it gets called with the timer name, a dict of labels and the duration in seconds, on the
+thread that made the measurement, so keep it quick.
+"""
+
+METRICS_ENABLED = getattr(constants, 'METRICS_ENABLED', False)
+PREFIX = "cipherwallet_"
+
+lock = lazy.Lock()
+timers = {}         # (name, labels) -> [count, total seconds]
+counters = {}       # (name, labels) -> count
+collectors = []     # (name, function returning a dict of gauges, label of the nested dicts)
+hooks = []          # functions called with (name, labels, seconds) for every timing
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _observe(key, labels, seconds):
+    with lock:
+        timer = timers.get(key)
+        if timer is None:
+            timers[key] = [ 1, seconds ]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+    for hook in hooks:
+        hook(key[0], labels, seconds)
+
+def _count(key, n=1):
+    with lock:
+        counters[key] = counters.get(key, 0) + n
+
+
+def observe(name, seconds, **labels):
+    """
+    record the duration of one operation
+    """
+    _observe(_key(name, labels), labels, seconds)
+
+def count(name, n=1, **labels):
+    """
+    add to a counter
+    """
+    _count(_key(name, labels), n)
+
+def timed(name, **labels):
+    """
+    decorator that times the calls of a function, and counts the ones that raised an
+        exception; it returns the function untouched when the metrics are not enabled
+    """
+    def decorator(f):
+        if not METRICS_ENABLED:
+            return f
+        key = _key(name, labels)
+        errors_key = _key(name + "_errors", labels)
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                _count(errors_key)
+                raise
+            finally:
+                _observe(key, labels, time.time() - t0)
+        return wrapper
+    return decorator
+
+
+def add_hook(hook):
+    """
+    register a function to be called with (name, labels, seconds) for every timing
+    """
+    hooks.append(hook)
+
+def add_collector(name, function, label=None):
+    """
+    register a function returning a dict of numbers, exported as gauges when the metrics
+        are rendered; if the values are dicts themselves, their keys become the label
+    """
+    collectors.append((name, function, label))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ) + "}"
+
+def render():
+    """
+    all the metrics, in the prometheus text exposition format
+    """
+    samples = {}    # metric -> (type, [sample lines])
+    def add(metric, kind, line):
+        samples.setdefault(metric, (kind, []))[1].append(line)
+
+    with lock:
+        timer_items = [ (key, list(timer)) for key, timer in timers.items() ]
+        counter_items = list(counters.items())
+    for (name, labels), (n, total) in timer_items:
+        metric = PREFIX + name + "_seconds"
+        add(metric, "summary", "{0}_count{1} {2}".format(metric, _format_labels(labels), n))
+        add(metric, "summary", "{0}_sum{1} {2!r}".format(metric, _format_labels(labels), total))
+    for (name, labels), n in counter_items:
+        metric = PREFIX + name + "_total"
+        add(metric, "counter", "{0}{1} {2}".format(metric, _format_labels(labels), n))
+
+    for name, function, label in collectors:
+        try:
+            stats = function()
+        except Exception:
+            # a collector that fails (e.g. before its pool exists) is left out
+            continue
+        groups = stats.items() if label else [ (None, stats) ]
+        for group, values in groups:
+            labels = ((label, group),) if label else ()
+            for k, v in values.items():
+                if isinstance(v, (bool, int, long, float)):
+                    metric = PREFIX + name + "_" + k
+                    add(metric, "gauge", "{0}{1} {2}".format(metric, _format_labels(labels), float(v)))
+
+    lines = []
+    for metric in sorted(samples):
+        kind, metric_lines = samples[metric]
+        lines.append("# TYPE {0} {1}".format(metric, kind))
+        lines.extend(sorted(metric_lines))
+    return "\n".join(lines) + "\n"
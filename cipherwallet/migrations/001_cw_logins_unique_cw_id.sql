@@ -0,0 +1,8 @@
+-- adds a unique index on cw_logins.cw_id, used by every QR login to look up the user
+-- (tables created from the schema in constants.sample.py after version 1.0 already have it)
+-- works as is on sqlite, postgresql and mysql; on a large postgresql table you may want to 
+--    use CREATE UNIQUE INDEX CONCURRENTLY instead, to avoid locking the table while it builds
+-- the index can't be created if there are duplicate cipherwallet IDs; to find them:
+--    SELECT cw_id, COUNT(*) FROM cw_logins GROUP BY cw_id HAVING COUNT(*) > 1;
+
+CREATE UNIQUE INDEX cw_logins_cw_id ON cw_logins (cw_id);
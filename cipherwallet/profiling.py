@@ -0,0 +1,187 @@
+import sys
+import json
+import time
+import signal
+import logging
+import itertools
+import threading
+import functools
+import collections
+import logging.handlers
+
+import constants
+
+####  sampled per-request traces, for looking into slow requests in production  ####
+"""
+With PROFILE_SAMPLE_RATE = N, one in every N requests to the api_router handlers gets
+traced; with PROFILE_SLOW_THRESHOLD set, so does every request that takes longer than
+that many seconds. A trace is the duration of the request, broken down into spans: the
+CQR signature checks, the nonce check, the temp store operations, the database lookups,
+the cipherwallet API requests and the call to hooks.authorize_session_for_user().
+
+The traces are kept in a ring buffer holding the latest PROFILE_RING_SIZE of them, and
+are also appended to PROFILE_FILE (one JSON object per line, rotated), if it is set.
+Call dump() to print the ring buffer, or set PROFILE_DUMP_SIGNAL (e.g. "SIGUSR2") and
+send the process that signal.
+
+Nothing gets traced when neither PROFILE_SAMPLE_RATE nor PROFILE_SLOW_THRESHOLD is set.
+Otherwise, a request that doesn't get sampled costs a thread-local lookup per span; but
+catching the slow requests means timing every request.
+"""
+
+PROFILE_SAMPLE_RATE = getattr(constants, 'PROFILE_SAMPLE_RATE', 0)
+PROFILE_SLOW_THRESHOLD = getattr(constants, 'PROFILE_SLOW_THRESHOLD', 0)
+PROFILE_RING_SIZE = getattr(constants, 'PROFILE_RING_SIZE', 1000)
+PROFILE_FILE = getattr(constants, 'PROFILE_FILE', None)
+PROFILE_FILE_MAX_BYTES = getattr(constants, 'PROFILE_FILE_MAX_BYTES', 10 * 1024 * 1024)
+PROFILE_FILE_BACKUPS = getattr(constants, 'PROFILE_FILE_BACKUPS', 3)
+PROFILE_DUMP_SIGNAL = getattr(constants, 'PROFILE_DUMP_SIGNAL', None)
+
+PROFILING_ENABLED = bool(PROFILE_SAMPLE_RATE or PROFILE_SLOW_THRESHOLD)
+
+ring = collections.deque(maxlen=PROFILE_RING_SIZE)
+requests_seen = itertools.count()
+# the trace of the request being served by the current thread, if any
+current = threading.local()
+
+trace_log = None
+if PROFILING_ENABLED and PROFILE_FILE:
+    trace_log = logging.getLogger("cipherwallet.profiling")
+    trace_log.propagate = False
+    trace_log.setLevel(logging.INFO)
+    trace_log.addHandler(logging.handlers.RotatingFileHandler(
+        PROFILE_FILE, maxBytes=PROFILE_FILE_MAX_BYTES, backupCount=PROFILE_FILE_BACKUPS
+    ))
+
+
+class _Span(object):
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        self.trace['depth'] += 1
+
+    def __exit__(self, *exc):
+        self.trace['depth'] -= 1
+        self.trace['spans'].append({
+            'name': self.name,
+            'depth': self.trace['depth'],
+            'at_ms': round((self.started - self.trace['time']) * 1000, 3),
+            'ms': round((time.time() - self.started) * 1000, 3),
+        })
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+no_span = _NoSpan()
+
+
+def span(name):
+    """
+    a context manager measuring a part of the request that is being traced
+    """
+    trace = getattr(current, 'trace', None)
+    return no_span if trace is None else _Span(trace, name)
+
+def spanned(name):
+    """
+    decorator that measures every call of a function as a span; it returns the function
+        untouched when the profiling is not enabled
+    """
+    def decorator(f):
+        if not PROFILING_ENABLED:
+            return f
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            trace = getattr(current, 'trace', None)
+            if trace is None:
+                return f(*args, **kwargs)
+            with _Span(trace, name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced(handler):
+    """
+    decorator for the route handlers: traces the requests that get sampled, and keeps the
+        traces of the sampled or slow ones
+    """
+    if not PROFILING_ENABLED:
+        return handler
+    route = handler.__name__.lstrip("_")
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        sampled = PROFILE_SAMPLE_RATE and next(requests_seen) % PROFILE_SAMPLE_RATE == 0
+        if not sampled and not PROFILE_SLOW_THRESHOLD:
+            return handler(*args, **kwargs)
+        trace = current.trace = { 'route': route, 'time': time.time(), 'depth': 0, 'spans': [] }
+        try:
+            return handler(*args, **kwargs)
+        except Exception as e:
+            # bottle's http responses (like the 202s of the polls) are exceptions too
+            if hasattr(e, 'status_code'):
+                trace['status'] = e.status_code
+            else:
+                trace['error'] = type(e).__name__
+            raise
+        finally:
+            current.trace = None
+            trace['ms'] = round((time.time() - trace['time']) * 1000, 3)
+            if sampled or trace['ms'] >= PROFILE_SLOW_THRESHOLD * 1000:
+                trace['reason'] = "sampled" if sampled else "slow"
+                del trace['depth']
+                _keep(trace)
+    return wrapper
+
+
+def _keep(trace):
+    ring.append(trace)
+    if trace_log is not None:
+        trace_log.info(json.dumps(trace, sort_keys=True))
+
+def traces():
+    """
+    the traces in the ring buffer, oldest first
+    """
+    return list(ring)
+
+def dump(stream=None):
+    """
+    print the traces in the ring buffer, oldest first, with their spans indented by nesting
+    """
+    stream = stream or sys.stderr
+    for trace in traces():
+        outcome = ""
+        if 'status' in trace:
+            outcome = " status {0}".format(trace['status'])
+        elif 'error' in trace:
+            outcome = " error " + trace['error']
+        stream.write("{0} {1} {2:.3f}ms ({3}){4}\n".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace['time'])),
+            trace['route'], trace['ms'], trace['reason'], outcome
+        ))
+        # spans are recorded when they end, show them in the order they started
+        for s in sorted(trace['spans'], key=lambda s: (s['at_ms'], s['depth'])):
+            stream.write("    {0}+{1:.3f}ms {2} {3:.3f}ms\n".format(
+                "    " * s['depth'], s['at_ms'], s['name'], s['ms']
+            ))
+    stream.flush()
+
+def _dump_on_signal(signum, frame):
+    dump()
+
+if PROFILING_ENABLED and PROFILE_DUMP_SIGNAL:
+    try:
+        signal.signal(getattr(signal, PROFILE_DUMP_SIGNAL), _dump_on_signal)
+    except ValueError:
+        # signal handlers can only be set from the main thread
+        pass
@@ -0,0 +1,126 @@
+import time
+import threading
+import collections
+
+import constants
+import lazy
+
+####  pool of QR codes generated ahead of time  ####
+"""
+A background thread keeps a number of ready-made cipherwallet sessions for each QR code
+tag that asks for it (with a 'pool_depth' entry in its qr_requests service descriptor).
+Each pooled session already has its QR code image, obtained from the cipherwallet API,
+so a page view gets its QR code without waiting for the API round-trip.
+
+Keep in mind that every pooled QR code is a real request to the cipherwallet API, whether
+it ends up being displayed or not: a tag with a pool depth of N costs about N API requests
+per QR code time-to-live, even when nobody visits the page.
+"""
+
+# how often (in seconds) the background thread tops up the pool
+QR_POOL_REFILL_INTERVAL = getattr(constants, 'QR_POOL_REFILL_INTERVAL', 1)
+# max number of QR codes requested from the API, per tag, on each refill round
+QR_POOL_REFILL_BATCH = getattr(constants, 'QR_POOL_REFILL_BATCH', 5)
+# pooled QR codes with less than this many seconds to live are not handed out anymore
+QR_POOL_MIN_TTL = getattr(constants, 'QR_POOL_MIN_TTL', 20)
+
+
+class QRPool(object):
+
+    def __init__(self, generate, depths):
+        """
+        generate(tag) must return a (png, cw_session, expires) tuple, or None on failure
+        depths is a map of QR code tags to the number of QR codes to keep ready for them
+        """
+        self.generate = generate
+        self.depths = depths
+        self._reset()
+
+    def _reset(self):
+        self.ready = dict((tag, collections.deque()) for tag in self.depths)
+        self.counters = dict(
+            (tag, { 'hits': 0, 'misses': 0, 'generated': 0, 'discarded': 0, 'errors': 0 })
+            for tag in self.depths
+        )
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.pid = lazy.pid()
+
+    def _check_fork(self):
+        # a forked child starts over with an empty pool: the QR codes it inherited get handed 
+        #    out by the parent, or by the other children, and the parent's worker thread may 
+        #    have been holding the lock at the time of the fork
+        if self.pid != lazy.pid():
+            self._reset()
+
+    def take(self, tag):
+        """
+        hand out a ready-made (png, cw_session) pair for the tag, or None if there is none
+        """
+        if tag not in self.depths:
+            return None
+        self._check_fork()
+        self._start()
+        deadline = time.time() + QR_POOL_MIN_TTL
+        with self.lock:
+            q = self.ready[tag]
+            while q:
+                png, cw_session, expires = q.popleft()
+                if expires > deadline:
+                    self.counters[tag]['hits'] += 1
+                    return png, cw_session
+                self.counters[tag]['discarded'] += 1
+            self.counters[tag]['misses'] += 1
+        # ran dry, dont wait for the next refill round
+        self.wakeup.set()
+        return None
+
+    def stats(self):
+        """
+        pool depth, QR codes ready to go and hit / miss counters, for each tag
+        """
+        self._check_fork()
+        with self.lock:
+            return dict(
+                (tag, dict(self.counters[tag], depth=self.depths[tag], ready=len(self.ready[tag])))
+                for tag in self.depths
+            )
+
+    def _start(self):
+        # the worker thread starts on first use, so that it's created in the process
+        #    that serves the requests
+        if self.worker is None or not self.worker.is_alive():
+            with self.lock:
+                if self.worker is None or not self.worker.is_alive():
+                    self.worker = threading.Thread(target=self._run, name="cipherwallet-qr-pool")
+                    self.worker.daemon = True
+                    self.worker.start()
+
+    def _run(self):
+        while True:
+            for tag in self.depths:
+                self._refill(tag)
+            self.wakeup.wait(QR_POOL_REFILL_INTERVAL)
+            self.wakeup.clear()
+
+    def _refill(self, tag):
+        # drop the QR codes that are about to expire, then request new ones up to the depth
+        deadline = time.time() + QR_POOL_MIN_TTL
+        with self.lock:
+            q = self.ready[tag]
+            while q and q[0][2] <= deadline:
+                q.popleft()
+                self.counters[tag]['discarded'] += 1
+            missing = min(self.depths[tag] - len(q), QR_POOL_REFILL_BATCH)
+        for _ in range(missing):
+            try:
+                item = self.generate(tag)
+            except Exception:
+                item = None
+            with self.lock:
+                if item is None:
+                    self.counters[tag]['errors'] += 1
+                    return
+                self.ready[tag].append(item)
+                self.counters[tag]['generated'] += 1
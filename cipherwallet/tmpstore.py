@@ -0,0 +1,99 @@
+import importlib
+
+from constants import TMP_DATASTORE
+import metrics
+import profiling
+
+####  temporary storage facility interface  ####
+"""
+The temporary storage (temp store) keeps the short lived data: the nonces, the cipherwallet
+sessions opened by the QR codes, and the data in transit between the mobile app and the
+web page. The backend is a module called cipherwallet.tmpstore_<name>, selected by the
+TMP_DATASTORE constant, that provides all the functions listed in REQUIRED:
+
+    is_nonce_valid(user, nonce, ttl)
+        atomically claim a nonce for ttl seconds; False if it was claimed already
+    cw_session_data(session_id, var, value=None)
+        get (without a value) or set a cipherwallet session variable
+    cw_session_update(session_id, **session_vars)
+        set several session variables at once; returns session_vars, or None on failure
+    poll_snapshot(session_id)
+        (session expiration time, user data, user identification data, time the QR code
+        was handed out) in one go
+    set_user_data(session_id, user_data) / get_user_data(session_id)
+        the data posted by the mobile app; get returns it JSON-encoded
+    set_user_ident(session_id, user_ident) / get_user_ident(session_id)
+        the (JSON-encoded) login credentials posted by the cipherwallet API
+    set_signup_registration_for_session(session_id, registration, complete_duration)
+    get_signup_registration_for_session(session_id)
+        the new user's cipherwallet login credentials, until the signup completes
+
+The setters return None when they fail. A backend may also implement the functions
+listed in OPTIONAL:
+
+    wait_for_user_data(session_id, timeout)
+        block until user data or user identification data arrives for the session, or
+        until timeout seconds pass; True if the data arrived
+    warmup()
+        import the client library and create the clients up front, instead of on first
+        use (called by cipherwallet_lib.warmup())
+"""
+
+K_NONCE = "CQR_NONCE_{0}_{1}"       # + user, nonce
+K_CW_SESSION = "CW_SESSION_{0}"     # + cipherwallet session id
+K_USER_DATA = "CW_USER_DATA_{0}"    # + cw session id
+K_SIGNUP_REG  = "CW_SIGNUP_REG_{0}" # + cw session id
+K_USER_IDENT = "CW_USERIDENT_{0}"   # + cw session id
+
+# how long (seconds) the data posted by the mobile app waits to be picked up by a poll
+USER_DATA_TTL = 30
+
+REQUIRED = (
+    'is_nonce_valid',
+    'cw_session_data',
+    'cw_session_update',
+    'poll_snapshot',
+    'set_user_data',
+    'get_user_data',
+    'set_user_ident',
+    'get_user_ident',
+    'set_signup_registration_for_session',
+    'get_signup_registration_for_session',
+)
+OPTIONAL = (
+    'wait_for_user_data',
+    'warmup',
+)
+
+
+class _Wrapped(object):
+    """
+    stands in for a backend module, with the interface functions replaced by 
+        wrap(function name, function); the backend's own calls to them are not affected
+    """
+
+    def __init__(self, backend, wrap):
+        self._backend = backend
+        for f in REQUIRED + OPTIONAL:
+            if callable(getattr(backend, f, None)):
+                setattr(self, f, wrap(f, getattr(backend, f)))
+
+    def __getattr__(self, attr):
+        return getattr(self._backend, attr)
+
+
+def load(name=TMP_DATASTORE):
+    """
+    import a temp store backend, and check that it implements the interface
+    with the metrics enabled, the interface functions get timed (labelled with the backend 
+        name); with the profiling enabled, they show up as spans in the request traces
+    """
+    backend = importlib.import_module("cipherwallet.tmpstore_{0}".format(name))
+    missing = [ f for f in REQUIRED if not callable(getattr(backend, f, None)) ]
+    if missing:
+        raise ImportError("temp store '{0}' doesn't implement {1}".format(name, ", ".join(missing)))
+    if metrics.METRICS_ENABLED:
+        backend = _Wrapped(backend, lambda f, function: metrics.timed("tmpstore", op=f, backend=name)(function))
+    if profiling.PROFILING_ENABLED:
+        backend = _Wrapped(backend, lambda f, function: profiling.spanned("tmpstore." + f)(function))
+    return backend
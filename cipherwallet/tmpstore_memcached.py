@@ -1,19 +1,18 @@
 import random
-import json
-import pylibmc
 
 from constants import MCD_CONFIG, CW_SESSION_TIMEOUT, ALPHABET, H_METHOD
+import codec
 import db_interface as db
+import lazy
+from tmpstore import (
+    K_NONCE, K_CW_SESSION, K_USER_DATA, K_SIGNUP_REG, K_USER_IDENT, USER_DATA_TTL
+)
 
 ####  temporary storage facility using memcached  ####
 
-K_NONCE = "CQR_NONCE_{0}_{1}"       # + user, nonce
-K_CW_SESSION = "CW_SESSION_{0}"     # + cipherwallet session id
-K_USER_DATA = "CW_USER_DATA_{0}"    # + cw session id
-K_SIGNUP_REG  = "CW_SIGNUP_REG_{0}" # + cw session id
-K_USER_IDENT = "CW_USERIDENT_{0}"   # + cw session id
-
-mcd = pylibmc.Client(MCD_CONFIG)   # configuration comes from __init__.py
+pylibmc = lazy.lazy_import("pylibmc")
+# created on first use; configuration comes from constants.py
+mcd = lazy.LazyResource(lambda: pylibmc.Client(MCD_CONFIG))
 
 def is_nonce_valid(arg1, arg2, ttl):
     """
@@ -26,15 +25,42 @@ def cw_session_data(session_id, var, value=None):
     """
     cipherwallet session variables managed in the temp store
     """
-    json_s = mcd.get(K_CW_SESSION.format(session_id))
-    s = json.loads(json_s) if json_s is not None else None
     if value is None:
+        s = codec.decode(mcd.get(K_CW_SESSION.format(session_id)))
         return s.get(var) if s is not None else None
     else:
-        # session exist, set the session variable and re-save
-        if s is None: s = {}
-        s[var] = value
-        return value if mcd.set(K_CW_SESSION.format(session_id), json.dumps(s), time=CW_SESSION_TIMEOUT) else None
+        return value if cw_session_update(session_id, **{ var: value }) is not None else None
+
+
+def cw_session_update(session_id, **session_vars):
+    """
+    sets several cipherwallet session variables at once, with a single re-save
+    """
+    s = codec.decode(mcd.get(K_CW_SESSION.format(session_id))) or {}
+    s.update(session_vars)
+    if mcd.set(K_CW_SESSION.format(session_id), codec.encode(s), time=CW_SESSION_TIMEOUT):
+        return session_vars
+    else:
+        return None
+    
+
+def poll_snapshot(session_id):
+    """
+    everything a poll needs to look at, in one round-trip: the session expiration time, 
+       the user data, the user identification data and when a pooled QR code was handed 
+       out (None for whatever is missing)
+    """
+    k_session = K_CW_SESSION.format(session_id)
+    k_user_data = K_USER_DATA.format(session_id)
+    k_user_ident = K_USER_IDENT.format(session_id)
+    values = mcd.get_multi([ k_session, k_user_data, k_user_ident ])
+    s = codec.decode(values.get(k_session)) or {}
+    return (
+        s.get('qr_expires'), 
+        codec.as_json(values.get(k_user_data)), 
+        values.get(k_user_ident),
+        s.get('qr_served')
+    )
     
 
 def set_user_data(session_id, user_data):
@@ -43,7 +69,7 @@ def set_user_data(session_id, user_data):
        by the user device; the data is then picked up by the page ajax
        polling mechanism
     """
-    return session_id if mcd.set(K_USER_DATA.format(session_id), json.dumps(user_data), time=30) else None
+    return session_id if mcd.set(K_USER_DATA.format(session_id), codec.encode(user_data), time=USER_DATA_TTL) else None
 
 
 def get_user_data(session_id):
@@ -51,7 +77,7 @@ def get_user_data(session_id):
     the complement of the above: gets called by the web page polling mechanism to 
     retrieve data transmitted (POSTed) by the user's device, after scanning a QR code
     """
-    return mcd.get(K_USER_DATA.format(session_id))
+    return codec.as_json(mcd.get(K_USER_DATA.format(session_id)))
 
 
 def set_signup_registration_for_session(session_id, registration, complete_duration):
@@ -61,7 +87,7 @@ def set_signup_registration_for_session(session_id, registration, complete_durat
     it returns a new login credentials record
     """
     creds = db.create_cipherwallet_user(registration)
-    if mcd.set(K_SIGNUP_REG.format(session_id), json.dumps(creds), time=complete_duration):
+    if mcd.set(K_SIGNUP_REG.format(session_id), codec.encode(creds), time=complete_duration):
         del creds['registration']
         return creds
     else:
@@ -75,7 +101,7 @@ def get_signup_registration_for_session(session_id):
        confirmation tag that we saved with the function above
     """
     try:
-        return json.loads(mcd.get(K_SIGNUP_REG.format(session_id)))
+        return codec.decode(mcd.get(K_SIGNUP_REG.format(session_id)))
     except Exception:
         return None
 
@@ -86,7 +112,7 @@ def set_user_ident(session_id, user_ident):
        to temporarily store user identification data until it gets polled by the ajax 
        functions on the login page
     """
-    return session_id if mcd.set(K_USER_IDENT.format(session_id), user_ident, time=30) else None
+    return session_id if mcd.set(K_USER_IDENT.format(session_id), user_ident, time=USER_DATA_TTL) else None
 
 
 def get_user_ident(session_id):
@@ -95,3 +121,10 @@ def get_user_ident(session_id):
        to retrieve user identification data posted with the function above
     """
     return mcd.get(K_USER_IDENT.format(session_id))
+
+
+def warmup():
+    """
+    import pylibmc and create the client
+    """
+    mcd()
@@ -0,0 +1,223 @@
+import json
+import time
+import threading
+
+from constants import CW_SESSION_TIMEOUT
+import constants
+import db_interface as db
+import lazy
+from tmpstore import (
+    K_NONCE, K_CW_SESSION, K_USER_DATA, K_SIGNUP_REG, K_USER_IDENT, USER_DATA_TTL
+)
+
+####  temporary storage facility in the memory of the web app process  ####
+"""
+Everything lives in a dictionary of the current process, so this is only good for a web
+app that runs as a single process (any number of threads), and for tests. Whatever is
+stored here is lost when the process restarts.
+
+The dictionary is split in shards, each with its own lock, so that threads working on
+different keys rarely wait for each other. Expired keys are never returned; they are
+removed from memory by a timer wheel (a ring of one-second slots, each holding the keys
+that expire in that second), which advances as a side effect of writing new data.
+"""
+
+SHARDS = getattr(constants, 'MEMSTORE_SHARDS', 64)
+WHEEL_SLOTS = 1024
+
+shards = [ ({}, lazy.Lock()) for _ in range(SHARDS) ]   # key -> (expiration, value)
+
+wheel = [ set() for _ in range(WHEEL_SLOTS) ]
+wheel_lock = lazy.Lock()
+wheel_position = [ int(time.time()) ]
+
+# events for the polls waiting on user data, by session id: [event, waiters count]; the 
+#    polls waiting in a parent process are not there in a forked child
+waiters = {}
+waiters_lock = lazy.Lock(forked=waiters.clear)
+
+
+def __shard(key):
+    return shards[hash(key) % SHARDS]
+
+def __get(key):
+    data, lock = __shard(key)
+    item = data.get(key)
+    if item is None or item[0] < time.time():
+        return None
+    return item[1]
+
+def __set(key, value, ttl, only_new=False):
+    expires = time.time() + ttl
+    data, lock = __shard(key)
+    with lock:
+        if only_new:
+            item = data.get(key)
+            if item is not None and item[0] >= time.time():
+                return False
+        data[key] = (expires, value)
+    with wheel_lock:
+        wheel[int(expires) % WHEEL_SLOTS].add(key)
+    __advance_wheel()
+    return True
+
+def __advance_wheel():
+    """
+    remove the keys that expired in the seconds that passed since the wheel last turned
+    """
+    now = time.time()
+    with wheel_lock:
+        first = wheel_position[0]
+        if int(now) <= first:
+            return
+        wheel_position[0] = int(now)
+        for second in range(max(first, int(now) - WHEEL_SLOTS), int(now)):
+            slot = second % WHEEL_SLOTS
+            keys, wheel[slot] = wheel[slot], set()
+            for key in keys:
+                data, lock = __shard(key)
+                with lock:
+                    item = data.get(key)
+                    if item is None:
+                        continue
+                    if item[0] < now:
+                        del data[key]
+                    else:
+                        # saved again since, or expires on a later turn of the wheel
+                        wheel[int(item[0]) % WHEEL_SLOTS].add(key)
+
+def __notify(session_id):
+    with waiters_lock:
+        waiter = waiters.get(session_id)
+        if waiter is not None:
+            waiter[0].set()
+
+
+def is_nonce_valid(arg1, arg2, ttl):
+    """
+    adds a nonce with a limited time-to-live
+    failure means that a nonce with the same key already exists
+    """
+    return __set(K_NONCE.format(arg1, arg2), 0, ttl, only_new=True)
+
+
+def cw_session_data(session_id, var, value=None):
+    """
+    cipherwallet session variables managed in the temp store
+    """
+    if value is None:
+        s = __get(K_CW_SESSION.format(session_id))
+        return s.get(var) if s is not None else None
+    else:
+        return value if cw_session_update(session_id, **{ var: value }) is not None else None
+
+
+def cw_session_update(session_id, **session_vars):
+    """
+    sets several cipherwallet session variables at once
+    """
+    k = K_CW_SESSION.format(session_id)
+    data, lock = __shard(k)
+    with lock:
+        item = data.get(k)
+        s = dict(item[1]) if item is not None and item[0] >= time.time() else {}
+        s.update(session_vars)
+        data[k] = (time.time() + CW_SESSION_TIMEOUT, s)
+    with wheel_lock:
+        wheel[int(time.time() + CW_SESSION_TIMEOUT) % WHEEL_SLOTS].add(k)
+    return session_vars
+
+
+def poll_snapshot(session_id):
+    """
+    everything a poll needs to look at: the session expiration time, the user data,
+       the user identification data and when a pooled QR code was handed out (None for 
+       whatever is missing)
+    """
+    s = __get(K_CW_SESSION.format(session_id)) or {}
+    return (
+        s.get('qr_expires'),
+        get_user_data(session_id),
+        get_user_ident(session_id),
+        s.get('qr_served')
+    )
+
+
+def set_user_data(session_id, user_data):
+    """
+    this function temporarily stores data transmitted by user, when POSTed
+       by the user device; the data is then picked up by the page ajax
+       polling mechanism
+    """
+    __set(K_USER_DATA.format(session_id), json.dumps(user_data), USER_DATA_TTL)
+    __notify(session_id)
+    return session_id
+
+
+def get_user_data(session_id):
+    """
+    the complement of the above: gets called by the web page polling mechanism to
+    retrieve data transmitted (POSTed) by the user's device, after scanning a QR code
+    """
+    return __get(K_USER_DATA.format(session_id))
+
+
+def set_signup_registration_for_session(session_id, registration, complete_duration):
+    """
+    this function is called when the user's mobile app uploaded signup data,
+       in addition to the set_user_data() above
+    it returns a new login credentials record
+    """
+    creds = db.create_cipherwallet_user(registration)
+    __set(K_SIGNUP_REG.format(session_id), dict(creds), complete_duration)
+    del creds['registration']
+    return creds
+
+
+def get_signup_registration_for_session(session_id):
+    """
+    when the user completes the signup process (by submitting the data on the
+       signup page), we need to call this function to retrieve the registration
+       confirmation tag that we saved with the function above
+    """
+    creds = __get(K_SIGNUP_REG.format(session_id))
+    return dict(creds) if creds is not None else None
+
+
+def set_user_ident(session_id, user_ident):
+    """
+    on QR login, the push web service invoked by the cipherwallet API calls this function
+       to temporarily store user identification data until it gets polled by the ajax
+       functions on the login page
+    """
+    __set(K_USER_IDENT.format(session_id), user_ident, USER_DATA_TTL)
+    __notify(session_id)
+    return session_id
+
+
+def get_user_ident(session_id):
+    """
+    on QR login push, this function gets called by the login page poll mechanism
+       to retrieve user identification data posted with the function above
+    """
+    return __get(K_USER_IDENT.format(session_id))
+
+
+def wait_for_user_data(session_id, timeout):
+    """
+    parks a poll request until set_user_data() or set_user_ident() announce new data for
+       the session, or until timeout (seconds) expires; returns True if data arrived
+    """
+    with waiters_lock:
+        waiter = waiters.setdefault(session_id, [ threading.Event(), 0 ])
+        waiter[1] += 1
+    try:
+        # the data may have landed before we got here
+        if get_user_data(session_id) is not None or get_user_ident(session_id) is not None:
+            return True
+        return waiter[0].wait(timeout)
+    finally:
+        with waiters_lock:
+            waiter[1] -= 1
+            if waiter[1] == 0:
+                del waiters[session_id]
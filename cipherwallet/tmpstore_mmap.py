@@ -0,0 +1,312 @@
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import logging
+
+from constants import CW_SESSION_TIMEOUT
+import codec
+import constants
+import db_interface as db
+import lazy
+from tmpstore import (
+    K_NONCE, K_CW_SESSION, K_USER_DATA, K_SIGNUP_REG, K_USER_IDENT, USER_DATA_TTL
+)
+
+####  temporary storage facility in a memory-mapped file, shared by processes  ####
+"""
+All the web app processes running on the same host (like the workers forked by gunicorn
+or uwsgi) map the same file in memory, and use it as a fixed-size hash table. Reading a
+key is a plain memory access; writes are serialized with a lock on the file. Nothing
+is shared between hosts, so this only works when all the requests for a QR code session
+land on the same host.
+
+The table has MMAP_SLOTS slots of MMAP_SLOT_SIZE bytes each (the file size is the
+product of the two; on a tmpfs, only the slots that got written take up memory). Each slot
+has a header, then the key (up to KEY_MAX bytes), then the value; values that don't fit in
+a slot (more than MMAP_SLOT_SIZE - 146 bytes, once encoded) are refused, and logged. The
+largest value is the data of a signup form: set MMAP_SLOT_SIZE (or TMPSTORE_COMPRESS_MIN,
+see codec.py) accordingly. All the processes that share the file must have the same
+MMAP_SLOTS and MMAP_SLOT_SIZE; to change them, stop them all, or use a new MMAP_PATH. Keys are placed by linear
+probing, looking at no more than MAX_PROBE slots; expired slots get reused. Each slot
+header carries a version number that a writer makes odd while it changes the slot, so
+that readers can detect (and retry) a torn read without taking the lock. A slot left odd
+by a writer that died halfway (e.g. killed by the web server for taking too long) reads as
+missing, and gets marked as expired by the next writer that comes across it.
+
+Put the file on a tmpfs (like /dev/shm) to keep it off the disk.
+"""
+
+MMAP_PATH = getattr(constants, 'MMAP_PATH', "/dev/shm/cipherwallet.tmpstore")
+MMAP_SLOTS = getattr(constants, 'MMAP_SLOTS', 16384)
+MMAP_SLOT_SIZE = getattr(constants, 'MMAP_SLOT_SIZE', 8192)
+
+HEADER = struct.Struct("<IdHI")     # version, expiration, key length, value length
+KEY_MAX = 128
+VALUE_MAX = MMAP_SLOT_SIZE - HEADER.size - KEY_MAX
+MAX_PROBE = 32
+# how long (seconds) a reader waits for a slot that is being written; a writer only keeps it 
+#    for a few microseconds, unless it got killed in the middle of the write
+READ_TIMEOUT = 0.05
+
+log = logging.getLogger("cipherwallet.tmpstore_mmap")
+
+def __open():
+    fd = os.open(MMAP_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    try:
+        # the first process to get here sizes the file; the new space reads as zeros
+        if os.fstat(fd).st_size < MMAP_SLOTS * MMAP_SLOT_SIZE:
+            os.ftruncate(fd, MMAP_SLOTS * MMAP_SLOT_SIZE)
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+    return fd, mmap.mmap(fd, MMAP_SLOTS * MMAP_SLOT_SIZE, mmap.MAP_SHARED)
+
+# the file gets opened and mapped on first use
+mapped = lazy.LazyResource(__open)
+# the file lock serializes the processes, the thread lock the threads of this process
+thread_lock = lazy.Lock()
+
+
+class _Locked(object):
+
+    def __enter__(self):
+        # opening the file may fail, and so may the file lock: dont keep the thread lock then
+        fd = mapped()[0]
+        thread_lock.acquire()
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        except:
+            thread_lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        fcntl.lockf(mapped()[0], fcntl.LOCK_UN)
+        thread_lock.release()
+
+locked = _Locked()
+
+
+def __read_slot(slot, repair=False):
+    """
+    a consistent (version, expiration, key, value) view of a slot, or None if the slot stays 
+        in the middle of a write for longer than READ_TIMEOUT
+    with repair (only with the lock held, when no writer can be alive) a slot left in the 
+        middle of a write by a dead writer gets marked as expired, and read as such
+    """
+    table = mapped()[1]
+    offset = slot * MMAP_SLOT_SIZE
+    deadline = None
+    while True:
+        version, expires, key_len, value_len = HEADER.unpack_from(table, offset)
+        if version % 2 == 0:
+            key = table[offset + HEADER.size:offset + HEADER.size + key_len]
+            value = table[offset + HEADER.size + KEY_MAX:offset + HEADER.size + KEY_MAX + value_len]
+            if HEADER.unpack_from(table, offset)[0] == version:
+                return version, expires, key, value
+        elif repair:
+            # the key and value may be half written; the key length is still the one of the 
+            #    previous content, so the slot stays where it was in the probing sequences
+            HEADER.pack_into(table, offset, version + 1, 0, key_len, 0)
+            continue
+        if deadline is None:
+            deadline = time.time() + READ_TIMEOUT
+        elif time.time() > deadline:
+            return None
+        time.sleep(0)
+
+def __write_slot(slot, version, expires, key, value):
+    # only called with the lock held
+    table = mapped()[1]
+    offset = slot * MMAP_SLOT_SIZE
+    struct.pack_into("<I", table, offset, version + 1)
+    table[offset + HEADER.size:offset + HEADER.size + len(key)] = key
+    table[offset + HEADER.size + KEY_MAX:offset + HEADER.size + KEY_MAX + len(value)] = value
+    # the version goes last, when everything else in the slot is in place
+    struct.pack_into("<dHI", table, offset + 4, expires, len(key), len(value))
+    struct.pack_into("<I", table, offset, version + 2)
+
+def __probe(key):
+    """
+    the slots where key may live, in probing order
+    """
+    home = zlib.crc32(key) % MMAP_SLOTS
+    return ((home + i) % MMAP_SLOTS for i in range(MAX_PROBE))
+
+def __get(key):
+    now = time.time()
+    for slot in __probe(key):
+        content = __read_slot(slot)
+        if content is None:
+            # a dead writer's slot, repaired by the next __set() that comes across it
+            continue
+        version, expires, slot_key, value = content
+        if not slot_key:
+            # never used slot, the key is not in the table
+            return None
+        if slot_key == key:
+            return value if expires >= now else None
+    return None
+
+def __set(key, value, ttl, only_new=False, update=None):
+    """
+    save a value for key; with only_new, fail if the key exists already; with update,
+        the value is computed by update(old value or None) while holding the lock
+    """
+    if len(key) > KEY_MAX:
+        return False
+    with locked:
+        now = time.time()
+        target = reusable = None
+        for slot in __probe(key):
+            version, expires, slot_key, old = __read_slot(slot, repair=True)
+            if slot_key == key:
+                if expires < now:
+                    old = None
+                elif only_new:
+                    return False
+                target = slot
+                break
+            if not slot_key:
+                target = slot if reusable is None else reusable[0]
+                version = version if reusable is None else reusable[1]
+                old = None
+                break
+            if expires < now and reusable is None:
+                reusable = (slot, version)
+        else:
+            if reusable is None:
+                # this neighborhood of the table is full
+                return False
+            target, version = reusable
+            old = None
+        if update is not None:
+            value = update(old)
+        if len(value) > VALUE_MAX:
+            log.warning("%s: %d bytes, more than the %d that fit in a slot (see MMAP_SLOT_SIZE)", key, len(value), VALUE_MAX)
+            return False
+        __write_slot(target, version, now + ttl, key, value)
+        return True
+
+
+def is_nonce_valid(arg1, arg2, ttl):
+    """
+    adds a nonce with a limited time-to-live
+    failure means that a nonce with the same key already exists
+    """
+    return __set(K_NONCE.format(arg1, arg2), ".", ttl, only_new=True)
+
+
+def cw_session_data(session_id, var, value=None):
+    """
+    cipherwallet session variables managed in the temp store
+    """
+    if value is None:
+        s = codec.decode(__get(K_CW_SESSION.format(session_id)))
+        return s.get(var) if s is not None else None
+    else:
+        return value if cw_session_update(session_id, **{ var: value }) is not None else None
+
+
+def cw_session_update(session_id, **session_vars):
+    """
+    sets several cipherwallet session variables at once, with a single re-save
+    """
+    def updated(data):
+        s = codec.decode(data) or {}
+        s.update(session_vars)
+        return codec.encode(s)
+    if __set(K_CW_SESSION.format(session_id), None, CW_SESSION_TIMEOUT, update=updated):
+        return session_vars
+    else:
+        return None
+
+
+def poll_snapshot(session_id):
+    """
+    everything a poll needs to look at: the session expiration time, the user data,
+       the user identification data and when a pooled QR code was handed out (None for 
+       whatever is missing)
+    """
+    s = codec.decode(__get(K_CW_SESSION.format(session_id))) or {}
+    return (
+        s.get('qr_expires'),
+        get_user_data(session_id),
+        get_user_ident(session_id),
+        s.get('qr_served')
+    )
+
+
+def set_user_data(session_id, user_data):
+    """
+    this function temporarily stores data transmitted by user, when POSTed
+       by the user device; the data is then picked up by the page ajax
+       polling mechanism
+    """
+    if __set(K_USER_DATA.format(session_id), codec.encode(user_data), USER_DATA_TTL):
+        return session_id
+    else:
+        return None
+
+
+def get_user_data(session_id):
+    """
+    the complement of the above: gets called by the web page polling mechanism to
+    retrieve data transmitted (POSTed) by the user's device, after scanning a QR code
+    """
+    return codec.as_json(__get(K_USER_DATA.format(session_id)))
+
+
+def set_signup_registration_for_session(session_id, registration, complete_duration):
+    """
+    this function is called when the user's mobile app uploaded signup data,
+       in addition to the set_user_data() above
+    it returns a new login credentials record
+    """
+    creds = db.create_cipherwallet_user(registration)
+    if __set(K_SIGNUP_REG.format(session_id), codec.encode(creds), complete_duration):
+        del creds['registration']
+        return creds
+    else:
+        return None
+
+
+def get_signup_registration_for_session(session_id):
+    """
+    when the user completes the signup process (by submitting the data on the
+       signup page), we need to call this function to retrieve the registration
+       confirmation tag that we saved with the function above
+    """
+    try:
+        return codec.decode(__get(K_SIGNUP_REG.format(session_id)))
+    except Exception:
+        return None
+
+
+def set_user_ident(session_id, user_ident):
+    """
+    on QR login, the push web service invoked by the cipherwallet API calls this function
+       to temporarily store user identification data until it gets polled by the ajax
+       functions on the login page
+    """
+    if __set(K_USER_IDENT.format(session_id), user_ident, USER_DATA_TTL):
+        return session_id
+    else:
+        return None
+
+
+def get_user_ident(session_id):
+    """
+    on QR login push, this function gets called by the login page poll mechanism
+       to retrieve user identification data posted with the function above
+    """
+    return __get(K_USER_IDENT.format(session_id))
+
+
+def warmup():
+    """
+    open and map the table file
+    """
+    mapped()
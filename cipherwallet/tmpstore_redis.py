@@ -1,46 +1,195 @@
+import time
+import bisect
 import random
-import json
-import redis
+import struct
+import hashlib
+import threading
 
 from constants import (
     REDIS_HOST, REDIS_PORT, REDIS_DB,
     CW_SESSION_TIMEOUT, ALPHABET, H_METHOD
 )
+import codec
+import constants
 import db_interface as db
+import lazy
+from tmpstore import USER_DATA_TTL
 
 ####  temporary storage facility using redis  ####
+"""
+REDIS_MODE selects how the keys are spread over the redis servers:
 
-K_NONCE = "CQR_NONCE_{0}_{1}"       # + user, nonce
-K_CW_SESSION = "CW_SESSION_{0}"     # + cipherwallet session id
-K_USER_DATA = "CW_USER_DATA_{0}"    # + cw session id
-K_SIGNUP_REG  = "CW_SIGNUP_REG_{0}" # + cw session id
-K_USER_IDENT = "CW_USERIDENT_{0}"   # + cw session id
+    'single'    one redis server at REDIS_HOST:REDIS_PORT (the default)
+    'cluster'   a redis cluster, discovered from the REDIS_NODES [(host, port), ...] list
+    'sharded'   independent redis servers listed in REDIS_SHARDS [(host, port, db), ...],
+                with the keys assigned to them by a consistent hash ring on the client side
+
+All the keys of a cipherwallet session carry the session id as a hash tag (the part in
+curly braces), so in cluster mode they map to the same hash slot, and in sharded mode to
+the same server; a poll reads all of them with a single pipeline, from a single server.
+
+The poll reads may be served by read replicas: list them in REDIS_REPLICAS, as
+[(host, port), ...] in single mode, as {shard index: [(host, port), ...]} in sharded mode,
+or just set it to True in cluster mode. Replicas lag a little behind, which a poll can
+live with, so nothing else reads from them; even so, a session that a replica doesn't know
+about (yet) gets looked up on the primary.
+
+With REDIS_POOL_SIZE set, each server gets at most that many connections; when they are
+all busy, a request waits for one at most REDIS_POOL_TIMEOUT seconds.
+
+The polls parked by wait_for_user_data() dont hold a connection each: a single thread per
+redis primary (per process) subscribes to the notifications of all the sessions, and wakes
+up the polls waiting for them.
+"""
+
+REDIS_MODE = getattr(constants, 'REDIS_MODE', 'single')
+REDIS_NODES = getattr(constants, 'REDIS_NODES', [ (REDIS_HOST, REDIS_PORT) ])
+REDIS_SHARDS = getattr(constants, 'REDIS_SHARDS', [ (REDIS_HOST, REDIS_PORT, REDIS_DB) ])
+REDIS_REPLICAS = getattr(constants, 'REDIS_REPLICAS', None)
+REDIS_POOL_SIZE = getattr(constants, 'REDIS_POOL_SIZE', None)
+REDIS_POOL_TIMEOUT = getattr(constants, 'REDIS_POOL_TIMEOUT', 5)
+
+# the session id in curly braces is the hash tag
+K_NONCE = "CQR_NONCE_{{{0}_{1}}}"           # + user, nonce
+K_CW_SESSION = "CW_SESSION_{{{0}}}"         # + cipherwallet session id
+K_USER_DATA = "CW_USER_DATA_{{{0}}}"        # + cw session id
+K_SIGNUP_REG  = "CW_SIGNUP_REG_{{{0}}}"     # + cw session id
+K_USER_IDENT = "CW_USERIDENT_{{{0}}}"       # + cw session id
+K_NOTIFY = "CW_NOTIFY_{{{0}}}"              # + cw session id; pub/sub channel, not a key
+
+# points on the hash ring for each shard; more points spread the keys more evenly
+RING_POINTS = 160
+
+if REDIS_MODE not in ('single', 'cluster', 'sharded'):
+    raise ValueError("unknown REDIS_MODE '{0}'".format(REDIS_MODE))
+
+redis = lazy.lazy_import("redis")
+
+
+def __client(host, port, db=0):
+    if REDIS_POOL_SIZE:
+        pool = redis.BlockingConnectionPool(
+            host=host, port=port, db=db, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT
+        )
+    else:
+        pool = redis.ConnectionPool(host=host, port=port, db=db)
+    return redis.Redis(connection_pool=pool)
+
+def __cluster(read_from_replicas):
+    kw = { 'read_from_replicas': read_from_replicas }
+    if REDIS_POOL_SIZE:
+        kw['max_connections'] = REDIS_POOL_SIZE
+    try:
+        # redis-py 4.1 and later
+        from redis.cluster import RedisCluster, ClusterNode
+        return RedisCluster(startup_nodes=[ ClusterNode(h, p) for h, p in REDIS_NODES ], **kw)
+    except ImportError:
+        # the redis-py-cluster package, for older redis-py
+        from rediscluster import RedisCluster
+        return RedisCluster(startup_nodes=[ { 'host': h, 'port': p } for h, p in REDIS_NODES ], **kw)
+
+
+def __clients():
+    """
+    (primaries, readers): primaries[i] is the client of shard i, and readers[i] the clients 
+        its polls read from
+    """
+    if REDIS_MODE == 'cluster':
+        primaries = [ __cluster(False) ]
+        readers = [ [ __cluster(True) ] if REDIS_REPLICAS else primaries ]
+    elif REDIS_MODE == 'sharded':
+        primaries = [ __client(*shard) for shard in REDIS_SHARDS ]
+        readers = [
+            [ __client(h, p, shard[2]) for h, p in (REDIS_REPLICAS or {}).get(i, []) ] or [ primaries[i] ]
+            for i, shard in enumerate(REDIS_SHARDS)
+        ]
+    else:
+        primaries = [ __client(REDIS_HOST, REDIS_PORT, REDIS_DB) ]
+        readers = [ [ __client(h, p, REDIS_DB) for h, p in REDIS_REPLICAS or [] ] or primaries ]
+    return primaries, readers
+
+# redis gets imported, and the clients created, on first use
+clients = lazy.LazyResource(__clients)
+
+# the hash ring: sorted points, and the shard that owns the arc ending at each point
+def __point(s):
+    return struct.unpack(">I", hashlib.md5(s.encode()).digest()[:4])[0]
+
+ring = sorted(
+    (__point("{0}:{1}/{2}#{3}".format(h, p, d, n)), i)
+    for i, (h, p, d) in enumerate(REDIS_SHARDS if REDIS_MODE == 'sharded' else [])
+    for n in range(RING_POINTS)
+)
+ring_points = [ point for point, shard in ring ]
+
+
+def __shard(tag):
+    """
+    the index of the shard that owns the keys with this hash tag
+    """
+    if len(ring_points) <= RING_POINTS:
+        # a single shard
+        return 0
+    i = bisect.bisect(ring_points, __point(tag))
+    return ring[i % len(ring)][1]
+
+def __primary(tag):
+    return clients()[0][__shard(tag)]
+
+def __reader(tag):
+    return random.choice(clients()[1][__shard(tag)])
 
-# configuration constants come from __init__.py
-red = redis.Redis(connection_pool=redis.ConnectionPool(
-    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB
-))
 
 def is_nonce_valid(arg1, arg2, ttl):
     """
     adds a nonce with a limited time-to-live
     failure means that a nonce with the same key already exists
     """
-    return red.set(K_NONCE.format(arg1, arg2), 0, ex=ttl, nx=True)
+    return __primary("{0}_{1}".format(arg1, arg2)).set(K_NONCE.format(arg1, arg2), 0, ex=ttl, nx=True)
 
 def cw_session_data(session_id, var, value=None):
     """
     cipherwallet session variables managed in the temp store
     """
-    json_s = red.get(K_CW_SESSION.format(session_id))
-    s = json.loads(json_s) if json_s is not None else None
     if value is None:
-        return s.get(var) if s is not None else None
+        return codec.decode(__primary(session_id).hget(K_CW_SESSION.format(session_id), var))
     else:
-        # session exist, set the session variable and re-save
-        if s is None: s = {}
-        s[var] = value
-        return value if red.set(K_CW_SESSION.format(session_id), json.dumps(s), ex=CW_SESSION_TIMEOUT) else None
+        return value if cw_session_update(session_id, **{ var: value }) is not None else None
+
+
+def cw_session_update(session_id, **session_vars):
+    """
+    sets several cipherwallet session variables at once and refreshes the session expiration,  
+       in a single round-trip; the session is a redis hash, so concurrent writers of 
+       different variables dont overwrite each other
+    """
+    k = K_CW_SESSION.format(session_id)
+    # cluster pipelines can't do MULTI/EXEC, but both commands go to the same key anyway
+    pipe = __primary(session_id).pipeline(transaction=(REDIS_MODE != 'cluster'))
+    pipe.hset(k, mapping=dict((var, codec.encode(value)) for var, value in session_vars.items()))
+    pipe.expire(k, CW_SESSION_TIMEOUT)
+    return session_vars if pipe.execute()[-1] else None
+    
+
+def poll_snapshot(session_id):
+    """
+    everything a poll needs to look at, in one round-trip: the session expiration time, 
+       the user data, the user identification data and when a pooled QR code was handed 
+       out (None for whatever is missing)
+    the keys share the hash tag, so the pipeline goes to one server, a replica if there are any
+    a missing session would end the polling for good, so a replica that doesn't have it (yet, 
+       the first polls come right after the session gets created) is double checked with the 
+       primary; the user data showing up a little late does no harm
+    """
+    reader = __reader(session_id)
+    pipe = reader.pipeline(transaction=False)
+    pipe.hmget(K_CW_SESSION.format(session_id), 'qr_expires', 'qr_served')
+    pipe.get(K_USER_DATA.format(session_id))
+    pipe.get(K_USER_IDENT.format(session_id))
+    (expires, served), user_data, user_ident = pipe.execute()
+    if expires is None and reader is not __primary(session_id):
+        expires, served = __primary(session_id).hmget(K_CW_SESSION.format(session_id), 'qr_expires', 'qr_served')
+    return codec.decode(expires), codec.as_json(user_data), user_ident, codec.decode(served)
     
 
 def set_user_data(session_id, user_data):
@@ -49,7 +198,12 @@ def set_user_data(session_id, user_data):
        by the user device; the data is then picked up by the page ajax
        polling mechanism
     """
-    return session_id if red.set(K_USER_DATA.format(session_id), json.dumps(user_data), ex=30) else None
+    red = __primary(session_id)
+    if red.set(K_USER_DATA.format(session_id), codec.encode(user_data), ex=USER_DATA_TTL):
+        red.publish(K_NOTIFY.format(session_id), 1)
+        return session_id
+    else:
+        return None
 
 
 def get_user_data(session_id):
@@ -57,7 +211,7 @@ def get_user_data(session_id):
     the complement of the above: gets called by the web page polling mechanism to 
     retrieve data transmitted (POSTed) by the user's device, after scanning a QR code
     """
-    return red.get(K_USER_DATA.format(session_id))
+    return codec.as_json(__primary(session_id).get(K_USER_DATA.format(session_id)))
 
 
 def set_signup_registration_for_session(session_id, registration, complete_duration):
@@ -67,7 +221,7 @@ def set_signup_registration_for_session(session_id, registration, complete_durat
     it returns a new login credentials record
     """
     creds = db.create_cipherwallet_user(registration)
-    if red.set(K_SIGNUP_REG.format(session_id), json.dumps(creds), ex=complete_duration):
+    if __primary(session_id).set(K_SIGNUP_REG.format(session_id), codec.encode(creds), ex=complete_duration):
         del creds['registration']
         return creds
     else:
@@ -81,7 +235,7 @@ def get_signup_registration_for_session(session_id):
        confirmation tag that we saved with the function above
     """
     try:
-        return json.loads(red.get(K_SIGNUP_REG.format(session_id)))
+        return codec.decode(__primary(session_id).get(K_SIGNUP_REG.format(session_id)))
     except Exception:
         return None
 
@@ -92,7 +246,12 @@ def set_user_ident(session_id, user_ident):
        to temporarily store user identification data until it gets polled by the ajax 
        functions on the login page
     """
-    return session_id if red.set(K_USER_IDENT.format(session_id), user_ident, ex=30) else None
+    red = __primary(session_id)
+    if red.set(K_USER_IDENT.format(session_id), user_ident, ex=USER_DATA_TTL):
+        red.publish(K_NOTIFY.format(session_id), 1)
+        return session_id
+    else:
+        return None
 
 
 def get_user_ident(session_id):
@@ -100,4 +259,106 @@ def get_user_ident(session_id):
     on QR login push, this function gets called by the login page poll mechanism 
        to retrieve user identification data posted with the function above
     """
-    return red.get(K_USER_IDENT.format(session_id))
+    return __primary(session_id).get(K_USER_IDENT.format(session_id))
+
+
+class _Notifications(object):
+    """
+    the subscribers to the notifications of all the sessions, one thread (and one redis 
+        connection) for each primary, and the polls of this process waiting for them
+    """
+
+    # how long (seconds) to wait for the subscriptions to be in place, and between attempts 
+    #    to subscribe again when the connection is lost
+    SUBSCRIBE_TIMEOUT = 1
+
+    def __init__(self):
+        self.waiters = {}   # notification channel -> [ event, number of polls waiting on it ]
+        self.lock = threading.Lock()
+        subscriptions = []
+        for client in clients()[0]:
+            subscribed = threading.Event()
+            listener = threading.Thread(
+                target=self._listen, args=(client, subscribed), name="cipherwallet-redis-notify"
+            )
+            listener.daemon = True
+            listener.start()
+            subscriptions.append(subscribed)
+        for subscribed in subscriptions:
+            subscribed.wait(self.SUBSCRIBE_TIMEOUT)
+
+    def _listen(self, client, subscribed):
+        while True:
+            ps = client.pubsub()
+            try:
+                ps.psubscribe(K_NOTIFY.format("*"))
+                for message in ps.listen():
+                    if message['type'] == 'pmessage':
+                        self._wake([ message['channel'] ])
+                    elif message['type'] == 'psubscribe':
+                        subscribed.set()
+                        # notifications may have been missed while (re)subscribing
+                        with self.lock:
+                            channels = list(self.waiters)
+                        self._wake(channels)
+            except Exception:
+                pass
+            finally:
+                try:
+                    ps.close()
+                except Exception:
+                    pass
+            time.sleep(self.SUBSCRIBE_TIMEOUT)
+
+    def _wake(self, channels):
+        with self.lock:
+            for channel in channels:
+                waiter = self.waiters.get(channel)
+                if waiter is not None:
+                    waiter[0].set()
+
+    def register(self, session_id):
+        """
+        the event set when the session gets a notification
+        """
+        with self.lock:
+            waiter = self.waiters.setdefault(K_NOTIFY.format(session_id), [ threading.Event(), 0 ])
+            waiter[1] += 1
+            return waiter[0]
+
+    def unregister(self, session_id):
+        channel = K_NOTIFY.format(session_id)
+        with self.lock:
+            waiter = self.waiters[channel]
+            waiter[1] -= 1
+            if waiter[1] == 0:
+                del self.waiters[channel]
+
+# the subscriber threads start with the first parked poll (of each process)
+notifications = lazy.LazyResource(_Notifications)
+
+
+def wait_for_user_data(session_id, timeout):
+    """
+    parks a poll request until set_user_data() or set_user_ident() announce new data for 
+       the session, or until timeout (seconds) expires; returns True if data arrived
+    """
+    event = notifications().register(session_id)
+    try:
+        # the data may have landed before the caller's last look and our registration; both
+        #    keys are checked in one round-trip (they share the hash tag)
+        pipe = __primary(session_id).pipeline(transaction=False)
+        pipe.exists(K_USER_DATA.format(session_id))
+        pipe.exists(K_USER_IDENT.format(session_id))
+        if any(pipe.execute()):
+            return True
+        return event.wait(timeout)
+    finally:
+        notifications().unregister(session_id)
+
+
+def warmup():
+    """
+    import redis and create the clients, without connecting yet
+    """
+    clients()
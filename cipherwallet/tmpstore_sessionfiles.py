@@ -1,11 +1,18 @@
 import random
-import json
 import time
 import glob
+import errno
+import zlib
+import fcntl
 import os
 
 from constants import TMPSTORE_DIR, CW_SESSION_TIMEOUT, ALPHABET, H_METHOD
+import codec
+import constants
 import db_interface as db
+from tmpstore import (
+    K_NONCE, K_CW_SESSION, K_USER_DATA, K_SIGNUP_REG, K_USER_IDENT, USER_DATA_TTL
+)
 
 ####  temporary storage facility using plaintext files  ####
 """
@@ -13,36 +20,120 @@ Obviously, this is NOT the ideal alternative of implementing a temporary storage
 
 Some files become obsolete after a few seconds or minutes. To indicate the validity  
 of the files, as soon as we create them, we change the last-modified date to a 
-future date when the data is considered stale or invalid. You HAVE TO run a cron job 
-that deletes the obsoleted files, otherwise your directory will keep filling up.
-use the following command in a crontab that executes every hour:
+future date when the data is considered stale or invalid. 
+
+The files are spread over 256 subdirectories of TMPSTORE_DIR, by a hash of their name, 
+so that no directory grows too large. Every TMPSTORE_SWEEP_INTERVAL seconds, one of the 
+subdirectories gets cleaned up of the obsoleted files, as a side effect of writing new 
+data; a full sweep cycle takes 256 * TMPSTORE_SWEEP_INTERVAL seconds. You no longer need 
+a cron job for that - unless the store sits idle for long periods of time, in which case 
+nothing stops you from still running one:
     find /path/to/sessions/directory -type f -mmin +60 -delete
 """
 
-K_NONCE = "CQR_NONCE_{0}_{1}"       # + user, nonce
-K_CW_SESSION = "CW_SESSION_{0}"     # + cipherwallet session id
-K_USER_DATA = "CW_USER_DATA_{0}"    # + cw session id
-K_SIGNUP_REG  = "CW_SIGNUP_REG_{0}" # + cw session id
-K_USER_IDENT = "CW_USERIDENT_{0}"   # + cw session id
+SHARDS = 256
+TMPSTORE_SWEEP_INTERVAL = getattr(constants, 'TMPSTORE_SWEEP_INTERVAL', 10)
+# expired files are only deleted this many seconds after their expiration; this keeps the 
+#    sweeper (or a nonce reclaim) away from files that are still being created. the sweeper 
+#    and the nonce reclaims also lock the file (flock) before they delete or reuse it, so 
+#    that one doesn't act on a file the other one just reused or replaced
+EXPIRATION_GRACE = 5
+
+next_sweep = 0
+
+def __shard(fname):
+    return "{0:02x}".format(zlib.crc32(fname) % SHARDS)
 
-def __file_write_with_expiration(fname, content, ttl):
+def __path(fname):
+    return os.path.join(TMPSTORE_DIR, __shard(fname), fname)
+
+def __sweep():
+    """
+    remove the expired files from one of the subdirectories, if it's time to do so
+    """
+    global next_sweep
+    now = time.time()
+    if now < next_sweep:
+        return
+    next_sweep = now + TMPSTORE_SWEEP_INTERVAL
+    shard_dir = os.path.join(TMPSTORE_DIR, "{0:02x}".format(int(now / TMPSTORE_SWEEP_INTERVAL) % SHARDS))
     try:
-        fh = open(TMPSTORE_DIR + fname, "w")
-        fh.write(content)
-        fh.close()
-        # set the file's mtime to be the expiration date
-        os.utime(TMPSTORE_DIR + fname, (time.time(), ttl + time.time()))
+        fnames = os.listdir(shard_dir)
+    except OSError:
+        return
+    for fname in fnames:
+        try:
+            if os.stat(os.path.join(shard_dir, fname)).st_mtime < now - EXPIRATION_GRACE:
+                __locked_if_expired(os.path.join(shard_dir, fname), os.unlink)
+        except (OSError, IOError):
+            pass
+
+def __locked_if_expired(path, action):
+    """
+    action(path), holding a lock on the file, if the file is (still) there and long expired; 
+        returns whether it was
+    without blocking: if somebody else holds the lock, the file is theirs to act upon
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        st = os.fstat(fd)
+        if st.st_mtime >= time.time() - EXPIRATION_GRACE or os.stat(path).st_ino != st.st_ino:
+            # reused, or deleted (and maybe created again) before we got the lock
+            return False
+        action(path)
         return True
-    except:
+    finally:
+        os.close(fd)
+
+def __open_for_write(path, flags):
+    try:
+        return os.open(path, flags, 0o600)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # first file in this subdirectory
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        return os.open(path, flags, 0o600)
+
+def __file_write_with_expiration(fname, content, ttl, exclusive=False):
+    try:
+        path = __path(fname)
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+        fd = __open_for_write(path, flags)
+    except OSError:
+        return False
+    try:
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+        # set the file's mtime to be the expiration date
+        os.utime(path, (time.time(), ttl + time.time()))
+    except (OSError, IOError):
+        # don't leave a half written file behind (or a nonce that looks claimed)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
         return False
+    __sweep()
+    return True
 
 def __file_read_if_not_expired(fname):
     try:
+        path = __path(fname)
         # make sure the data is still valid (not expired)
-        if os.stat(TMPSTORE_DIR + fname).st_mtime < time.time():
+        if os.stat(path).st_mtime < time.time():
             return None
         # seems ok so far, return the file content
-        fh = open(TMPSTORE_DIR + fname, "r")
+        fh = open(path, "rb")
         content = fh.read()
         fh.close()
         return content
@@ -54,30 +145,62 @@ def is_nonce_valid(arg1, arg2, ttl):
     """
     create a file representing a nonce 
     if the file already exists, it means that the nonce attempts to being reused
+    the file is created in exclusive mode, so out of two concurrent requests with 
+       the same nonce, only one can succeed
     """
-    if TMPSTORE_DIR + K_NONCE.format(arg1, arg2) in os.listdir(TMPSTORE_DIR):
-        # we assume that the ttl is just approximatively OK, although the file 
-        # may linger around for another few minutes after its expiration
+    fname = K_NONCE.format(arg1, arg2)
+    if __file_write_with_expiration(fname, ".", ttl, exclusive=True):
+        return True
+    # the nonce file exists; if it's long expired, the nonce may be used again: the file is 
+    #    reused as it is, with a new expiration, under a lock, so that out of two concurrent 
+    #    reclaims only one succeeds (deleting and creating it again can't be done atomically)
+    path = __path(fname)
+    try:
+        if __locked_if_expired(path, lambda p: os.utime(p, (time.time(), time.time() + ttl))):
+            return True
+    except (OSError, IOError):
+        # somebody else holds the lock, and gets the nonce
         return False
-    return __file_write_with_expiration(K_NONCE.format(arg1, arg2), ".", ttl)
+    # not expired, or swept in the meantime
+    return not os.path.exists(path) and __file_write_with_expiration(fname, ".", ttl, exclusive=True)
     
 
 def cw_session_data(session_id, var, value=None):
     """
     cipherwallet session variables managed in the temp store
     """
-    json_s = __file_read_if_not_expired(K_CW_SESSION.format(session_id))
-    s = json.loads(json_s) if json_s is not None else None
     if value is None:
+        s = codec.decode(__file_read_if_not_expired(K_CW_SESSION.format(session_id)))
         return s.get(var) if s is not None else None
     else:
-        # session exist, set the session variable and re-save
-        if s is None: s = {}
-        s[var] = value
-        if __file_write_with_expiration(K_CW_SESSION.format(session_id), json.dumps(s), CW_SESSION_TIMEOUT):
-            return value 
-        else: 
-            return None
+        return value if cw_session_update(session_id, **{ var: value }) is not None else None
+
+
+def cw_session_update(session_id, **session_vars):
+    """
+    sets several cipherwallet session variables at once, with a single re-save
+    """
+    s = codec.decode(__file_read_if_not_expired(K_CW_SESSION.format(session_id))) or {}
+    s.update(session_vars)
+    if __file_write_with_expiration(K_CW_SESSION.format(session_id), codec.encode(s), CW_SESSION_TIMEOUT):
+        return session_vars
+    else: 
+        return None
+    
+
+def poll_snapshot(session_id):
+    """
+    everything a poll needs to look at: the session expiration time, the user data,
+       the user identification data and when a pooled QR code was handed out (None for 
+       whatever is missing)
+    """
+    s = codec.decode(__file_read_if_not_expired(K_CW_SESSION.format(session_id))) or {}
+    return (
+        s.get('qr_expires'), 
+        get_user_data(session_id), 
+        get_user_ident(session_id),
+        s.get('qr_served')
+    )
     
 
 def set_user_data(session_id, user_data):
@@ -87,7 +210,7 @@ def set_user_data(session_id, user_data):
        polling mechanism
     """
     
-    if __file_write_with_expiration(K_USER_DATA.format(session_id), json.dumps(user_data), 30):
+    if __file_write_with_expiration(K_USER_DATA.format(session_id), codec.encode(user_data), USER_DATA_TTL):
         return session_id 
     else:
         return None
@@ -98,7 +221,7 @@ def get_user_data(session_id):
     the complement of the above: gets called by the web page polling mechanism to 
     retrieve data transmitted (POSTed) by the user's device, after scanning a QR code
     """
-    return __file_read_if_not_expired(K_USER_DATA.format(session_id))
+    return codec.as_json(__file_read_if_not_expired(K_USER_DATA.format(session_id)))
 
 
 def set_signup_registration_for_session(session_id, registration, complete_duration):
@@ -108,7 +231,7 @@ def set_signup_registration_for_session(session_id, registration, complete_durat
     it returns a new login credentials record
     """
     creds = db.create_cipherwallet_user(registration)
-    if __file_write_with_expiration(K_SIGNUP_REG.format(session_id), json.dumps(creds), complete_duration):
+    if __file_write_with_expiration(K_SIGNUP_REG.format(session_id), codec.encode(creds), complete_duration):
         del creds['registration']
         return creds
     else:
@@ -122,7 +245,7 @@ def get_signup_registration_for_session(session_id):
        confirmation tag that we saved with the function above
     """
     try:
-        return json.loads(__file_read_if_not_expired(K_SIGNUP_REG.format(session_id)))
+        return codec.decode(__file_read_if_not_expired(K_SIGNUP_REG.format(session_id)))
     except Exception:
         return None
 
@@ -133,7 +256,7 @@ def set_user_ident(session_id, user_ident):
        to temporarily store user identification data until it gets polled by the ajax 
        functions on the login page
     """
-    if __file_write_with_expiration(K_USER_IDENT.format(session_id), user_ident, 30):
+    if __file_write_with_expiration(K_USER_IDENT.format(session_id), user_ident, USER_DATA_TTL):
         return session_id
     else:
         return None
@@ -1,3 +1,19 @@
+try:
+    # with gevent around, make all the blocking socket calls (cipherwallet API, temp store, 
+    #    database) cooperative, so that one process can serve lots of concurrent polls
+    from gevent import monkey
+    monkey.patch_all()
+    SERVER = "gevent"
+except ImportError:
+    SERVER = "wsgiref"
+else:
+    # psycopg2 is written in C, and the patching above doesn't reach its sockets
+    try:
+        import psycogreen.gevent
+        psycogreen.gevent.patch_psycopg()
+    except ImportError:
+        pass
+
 import time
 import bottle
 import bcrypt
@@ -82,4 +98,4 @@ def create_user(user_id):
 
 if __name__ == "__main__":
     bottle.debug(True)
-    bottle.run(host="127.0.0.1", port=8070, reloader=True)
+    bottle.run(host="127.0.0.1", port=8070, server=SERVER, reloader=True)
@@ -11,5 +11,9 @@ setup (
     download_url="https://github.com/drivefast/pycipherwallet/tarball/" + open("VERSION").read(),
     description="cipherwallet python SDK",
     long_description=open("BASICS.md").read(),
-    install_requires=["bottle", "sqlalchemy", "pylibmc","redis"],
+    install_requires=["bottle", "sqlalchemy", "pylibmc","redis", "requests"],
+    extras_require={"gevent": ["gevent"]},
+    entry_points={
+        "console_scripts": ["cw-logins = cipherwallet.bulk_logins:main"],
+    },
 )
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+conformance tests of the temp store backends: every backend must pass them
+
+    python -m unittest discover -s tests
+
+the redis backend is tested against fakeredis (skipped when redis or fakeredis is not
+    installed); the settings come from constants.sample.py, with the temp store files in a
+    scratch directory
+"""
+import os
+import sys
+import imp
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="cw-test-tmpstore-")
+
+
+def setUpModule():
+    # the constants module of the web app, made up from the sample file
+    if "cipherwallet.constants" not in sys.modules:
+        constants = imp.new_module("cipherwallet.constants")
+        constants.__file__ = os.path.join(ROOT, "cipherwallet", "constants.sample.py")
+        execfile(constants.__file__, constants.__dict__)
+        constants.TMP_DATASTORE = "memory"
+        constants.REDIS_HOST, constants.REDIS_PORT, constants.REDIS_DB = "localhost", 6379, 0
+        sys.modules["cipherwallet.constants"] = constants
+    constants = sys.modules["cipherwallet.constants"]
+    constants.TMPSTORE_DIR = os.path.join(WORKDIR, "sessionfiles") + "/"
+    constants.MMAP_PATH = os.path.join(WORKDIR, "tmpstore.mmap")
+
+def tearDownModule():
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+class BackendTests(object):
+    """
+    the tests, run by a TestCase subclass for each backend
+    """
+    backend_name = None
+
+    def setUp(self):
+        from cipherwallet import tmpstore
+        self.store = tmpstore.load(self.backend_name)
+
+    def session(self):
+        return uuid.uuid4().hex[:8] + "-test"
+
+    def test_duplicate_nonce_rejected(self):
+        user, nonce = "cw" + uuid.uuid4().hex[:8], uuid.uuid4().hex
+        self.assertTrue(self.store.is_nonce_valid(user, nonce, 60))
+        self.assertFalse(self.store.is_nonce_valid(user, nonce, 60))
+        self.assertTrue(self.store.is_nonce_valid(user, nonce + "x", 60))
+
+    def test_nonce_expires(self):
+        user, nonce = "cw" + uuid.uuid4().hex[:8], uuid.uuid4().hex
+        self.assertTrue(self.store.is_nonce_valid(user, nonce, 1))
+        time.sleep(2.1)
+        self.assertTrue(self.store.is_nonce_valid(user, nonce, 60))
+
+    def test_signup_registration_round_trip_and_expiry(self):
+        session = self.session()
+        creds = self.store.set_signup_registration_for_session(session, "reg-tag", 1)
+        self.assertNotIn('registration', creds)
+        saved = self.store.get_signup_registration_for_session(session)
+        self.assertEqual(saved['registration'], "reg-tag")
+        self.assertEqual(saved['cw_user'], creds['cw_user'])
+        self.assertEqual(saved['secret'], creds['secret'])
+        time.sleep(2.1)
+        self.assertIsNone(self.store.get_signup_registration_for_session(session))
+
+    def test_session_update_merges_variables(self):
+        session = self.session()
+        self.assertIsNone(self.store.cw_session_data(session, 'qr_expires'))
+        self.assertEqual(self.store.cw_session_update(session, qr_expires=1234), { 'qr_expires': 1234 })
+        self.assertEqual(self.store.cw_session_update(session, user_id="user@example.com"), { 'user_id': "user@example.com" })
+        self.assertEqual(self.store.cw_session_data(session, 'qr_expires'), 1234)
+        self.assertEqual(self.store.cw_session_data(session, 'user_id'), "user@example.com")
+        self.assertEqual(self.store.cw_session_data(session, 'qr_expires', 5678), 5678)
+        self.assertEqual(self.store.cw_session_data(session, 'qr_expires'), 5678)
+        self.assertEqual(self.store.cw_session_data(session, 'user_id'), "user@example.com")
+
+    def test_poll_snapshot(self):
+        session = self.session()
+        self.assertEqual(self.store.poll_snapshot(session), (None, None, None, None))
+        self.store.cw_session_update(session, qr_expires=1234)
+        self.assertEqual(self.store.poll_snapshot(session), (1234, None, None, None))
+        self.store.cw_session_update(session, qr_served=1200)
+        self.assertEqual(self.store.poll_snapshot(session), (1234, None, None, 1200))
+        self.store.set_user_data(session, { 'email': "user@example.com" })
+        expires, user_data, user_ident, served = self.store.poll_snapshot(session)
+        self.assertEqual((expires, json.loads(user_data), user_ident, served), (1234, { 'email': "user@example.com" }, None, 1200))
+        self.store.set_user_ident(session, '{"cw_user": "cw1234"}')
+        self.assertEqual(json.loads(self.store.poll_snapshot(session)[2]), { 'cw_user': "cw1234" })
+
+    def test_user_data_round_trip(self):
+        session = self.session()
+        self.assertIsNone(self.store.get_user_data(session))
+        user_data = { 'user': { 'first': u"Jérôme", 'last': "Doe" }, 'items': [ 1, 2.5, None, True ] }
+        self.assertEqual(self.store.set_user_data(session, user_data), session)
+        self.assertEqual(json.loads(self.store.get_user_data(session)), user_data)
+
+    def test_user_ident_round_trip(self):
+        session = self.session()
+        self.assertIsNone(self.store.get_user_ident(session))
+        user_ident = json.dumps({ 'cw_user': "cw1234", 'nonce': "abc", 'authorization': "x.y" })
+        self.assertEqual(self.store.set_user_ident(session, user_ident), session)
+        self.assertEqual(json.loads(self.store.get_user_ident(session)), json.loads(user_ident))
+
+    def test_wait_for_user_data_times_out(self):
+        if not callable(getattr(self.store, 'wait_for_user_data', None)):
+            self.skipTest("wait_for_user_data() not implemented")
+        t0 = time.time()
+        self.assertFalse(self.store.wait_for_user_data(self.session(), 0.3))
+        self.assertGreaterEqual(time.time() - t0, 0.25)
+
+    def test_wait_for_user_data_wakes_up(self):
+        if not callable(getattr(self.store, 'wait_for_user_data', None)):
+            self.skipTest("wait_for_user_data() not implemented")
+        for setter, value in [ (self.store.set_user_data, { 'a': 1 }), (self.store.set_user_ident, '{"b": 2}') ]:
+            session = self.session()
+            timer = threading.Timer(0.2, setter, (session, value))
+            timer.start()
+            t0 = time.time()
+            try:
+                self.assertTrue(self.store.wait_for_user_data(session, 5))
+                self.assertLess(time.time() - t0, 2)
+            finally:
+                timer.join()
+            # the data is there already
+            self.assertTrue(self.store.wait_for_user_data(session, 5))
+
+
+class MemoryTests(BackendTests, unittest.TestCase):
+    backend_name = "memory"
+
+
+class SessionFilesTests(BackendTests, unittest.TestCase):
+    backend_name = "sessionfiles"
+
+    def setUp(self):
+        BackendTests.setUp(self)
+        # expired nonces are normally kept for a few more seconds
+        from cipherwallet import tmpstore_sessionfiles
+        self.grace, tmpstore_sessionfiles.EXPIRATION_GRACE = tmpstore_sessionfiles.EXPIRATION_GRACE, 0
+
+    def tearDown(self):
+        from cipherwallet import tmpstore_sessionfiles
+        tmpstore_sessionfiles.EXPIRATION_GRACE = self.grace
+
+
+class MmapTests(BackendTests, unittest.TestCase):
+    backend_name = "mmap"
+
+
+class RedisTests(BackendTests, unittest.TestCase):
+    backend_name = "redis"
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import redis
+            import fakeredis
+        except ImportError:
+            raise unittest.SkipTest("redis and fakeredis are needed")
+        # all the clients talk to the same fakeredis server, in this process
+        pool = fakeredis.FakeRedis().connection_pool
+        cls.patched = redis.ConnectionPool, redis.BlockingConnectionPool
+        redis.ConnectionPool = redis.BlockingConnectionPool = lambda *a, **kw: pool
+
+    @classmethod
+    def tearDownClass(cls):
+        import redis
+        redis.ConnectionPool, redis.BlockingConnectionPool = cls.patched
+
+
+if __name__ == "__main__":
+    unittest.main()